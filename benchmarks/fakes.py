@@ -0,0 +1,354 @@
+'''
+Local stand-ins of BrasilAPI, Cloud Storage and BigQuery used by the benchmark, so the pipeline runs end to end
+without network access to brasilapi.com.br or Google Cloud. The Cloud Storage and BigQuery stand-ins are registered
+in ClientRegistry in place of the google.cloud clients, the classes of the pipeline run unchanged on top of them.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import fnmatch
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+
+
+class FakeBrasilApiServer:
+    '''
+    HTTP server answering any GET with a JSON list of municipalities, running in a background thread.
+
+    Parameters:
+        - rows (int, optional): Number of municipalities in each response.
+        - latency (float, optional): Seconds waited before answering each request.
+        - throttle_ratio (float, optional): Fraction of the requests answered with 429 Too Many Requests.
+    '''
+    def __init__(self, rows: int = 100, latency: float = 0.05, throttle_ratio: float = 0.0):
+        self.rows = rows
+        self.latency = latency
+        self.throttle_ratio = throttle_ratio
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.payloads = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target= self.server.serve_forever, daemon= True)
+
+    @property
+    def url(self) -> str:
+        '''
+        Base url of the server, to be used as the api_url of ApiOrquestrator.
+        '''
+        return f"http://127.0.0.1:{self.server.server_port}/api/"
+
+    def payload(self, path: str) -> bytes:
+        '''
+        Returns the body of a path, the same bytes on every request so the ETag stays valid.
+        '''
+        with self.lock:
+            if path not in self.payloads:
+                uf = path.rstrip('/').rsplit('/', 1)[-1][:2].upper()
+                content = [{'nome' : f"MUNICIPIO {uf} {index:05}", 'codigo_ibge' : f"{abs(hash(uf)) % 90 + 10}{index:05}"} for index in range(self.rows)]
+                self.payloads[path] = json.dumps(content).encode('utf-8')
+            return self.payloads[path]
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    throttle = random.random() < server.throttle_ratio
+                    server.throttled += int(throttle)
+                if server.latency:
+                    time.sleep(server.latency)
+                if throttle:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = server.payload(self.path.split('?', 1)[0])
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'FakeBrasilApiServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class InMemoryBlob:
+    '''
+    Blob of InMemoryBucket, with the subset of google.cloud.storage.Blob used by CloudStorage.
+    '''
+    def __init__(self, bucket: 'InMemoryBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.chunk_size = None
+        self.generation = None
+        self.size = None
+        self.md5_hash = None
+        self.updated = None
+        self.content_type = None
+
+    def upload_from_string(self, data, content_type: str = None, if_generation_match: int = None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bucket.store(self, data, content_type, if_generation_match)
+
+    def upload_from_file(self, file_obj, size: int = None, content_type: str = None, if_generation_match: int = None, **kwargs):
+        if size is None and self.chunk_size:
+            chunks = []
+            while True:
+                chunk = file_obj.read(self.chunk_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        else:
+            data = file_obj.read(size) if size is not None else file_obj.read()
+        self.bucket.store(self, data, content_type, if_generation_match)
+
+    def download_as_bytes(self, if_generation_match: int = None, **kwargs) -> bytes:
+        return self.bucket.load(self.name, if_generation_match)
+
+    def download_as_text(self, if_generation_match: int = None, **kwargs) -> str:
+        return self.download_as_bytes(if_generation_match).decode('utf-8')
+
+
+class InMemoryBucket:
+    '''
+    Bucket of InMemoryStorageClient, keeping the objects in a dictionary with their generation.
+    '''
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.objects = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def blob(self, name: str) -> InMemoryBlob:
+        return InMemoryBlob(self, name)
+
+    def store(self, blob: InMemoryBlob, data: bytes, content_type: str, if_generation_match: int = None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            current = self.objects.get(blob.name)
+            if if_generation_match is not None and (current['generation'] if current else 0) != if_generation_match:
+                from google.api_core.exceptions import PreconditionFailed
+                raise PreconditionFailed(f'Generation of {blob.name} does not match {if_generation_match}')
+            self.generation += 1
+            self.objects[blob.name] = {
+                'data' : data,
+                'generation' : self.generation,
+                'content_type' : content_type,
+                'metadata' : blob.metadata,
+                'md5_hash' : hashlib.md5(data).hexdigest(),
+                'updated' : time.time()
+            }
+            self.describe(blob, self.objects[blob.name])
+
+    def load(self, name: str, if_generation_match: int = None) -> bytes:
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            current = self.objects.get(name)
+        if current is None:
+            from google.api_core.exceptions import NotFound
+            raise NotFound(f'Object {name} not found')
+        if if_generation_match is not None and current['generation'] != if_generation_match:
+            from google.api_core.exceptions import PreconditionFailed
+            raise PreconditionFailed(f'Generation of {name} does not match {if_generation_match}')
+        return current['data']
+
+    @staticmethod
+    def describe(blob: InMemoryBlob, stored: dict) -> InMemoryBlob:
+        blob.generation = stored['generation']
+        blob.size = len(stored['data'])
+        blob.md5_hash = stored['md5_hash']
+        blob.updated = stored['updated']
+        blob.content_type = stored['content_type']
+        blob.metadata = stored['metadata']
+        return blob
+
+    def get_blob(self, name: str) -> InMemoryBlob:
+        with self.lock:
+            stored = self.objects.get(name)
+        if stored is None:
+            return None
+        return self.describe(InMemoryBlob(self, name), stored)
+
+    def list_blobs(self, prefix: str = None, delimiter: str = None, match_glob: str = None, page_size: int = None):
+        with self.lock:
+            names = sorted(self.objects)
+        blobs = []
+        for name in names:
+            if prefix and not name.startswith(prefix):
+                continue
+            if delimiter and delimiter in name[len(prefix or ''):]:
+                continue
+            if match_glob and not fnmatch.fnmatchcase(name, match_glob.replace('**', '*')):
+                continue
+            blob = self.get_blob(name)
+            if blob is not None:
+                blobs.append(blob)
+        page_size = page_size or 1000
+        return SimpleNamespace(pages= [blobs[index:index + page_size] for index in range(0, len(blobs), page_size)])
+
+    def delete(self):
+        with self.lock:
+            self.objects.clear()
+
+
+class InMemoryStorageClient:
+    '''
+    Stand-in of google.cloud.storage.Client, buckets are created on first use.
+
+    Parameters:
+        - latency (float, optional): Seconds waited on each upload and download.
+    '''
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, bucket_name: str) -> InMemoryBucket:
+        with self.lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = InMemoryBucket(bucket_name, self.latency)
+            return self.buckets[bucket_name]
+
+    bucket = get_bucket
+
+    def create_bucket(self, bucket_name: str, location: str = None) -> InMemoryBucket:
+        return self.get_bucket(bucket_name)
+
+    def list_buckets(self) -> list:
+        with self.lock:
+            return list(self.buckets.values())
+
+
+class InMemoryBigQueryClient:
+    '''
+    Stand-in of google.cloud.bigquery.Client counting the rows loaded in each table. Parquet and newline delimited
+    JSON loads are parsed to count their rows, the files of URI loads are read from the Cloud Storage stand-in.
+
+    Parameters:
+        - storage_client (InMemoryStorageClient): The Cloud Storage stand-in of the gs:// uris.
+        - latency (float, optional): Seconds waited on each load job and query.
+    '''
+    project = 'benchmark'
+
+    def __init__(self, storage_client: InMemoryStorageClient, latency: float = 0.0):
+        self.storage_client = storage_client
+        self.latency = latency
+        self.tables = {}
+        self.jobs = 0
+        self.lock = threading.Lock()
+
+    def dataset(self, dataset_name: str):
+        return SimpleNamespace(table= lambda table_name : f"{dataset_name}.{table_name}")
+
+    def append(self, table: str, rows: int, write_disposition: str = None) -> SimpleNamespace:
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.jobs += 1
+            if write_disposition == 'WRITE_TRUNCATE':
+                self.tables[table] = 0
+            self.tables[table] = self.tables.get(table, 0) + rows
+        return SimpleNamespace(result= lambda : None, output_rows= rows, input_file_bytes= None, num_dml_affected_rows= rows)
+
+    @staticmethod
+    def count_rows(data: bytes) -> int:
+        if data[:4] == b'PAR1':
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(io.BytesIO(data)).metadata.num_rows
+        if data[:2] == b'\x1f\x8b':
+            import gzip
+            data = gzip.decompress(data)
+        return sum(1 for line in data.splitlines() if line.strip())
+
+    def load_table_from_file(self, file_obj, table: str, job_config = None) -> SimpleNamespace:
+        return self.append(table, self.count_rows(file_obj.read()), getattr(job_config, 'write_disposition', None))
+
+    def load_table_from_dataframe(self, dataframe, table: str, job_config = None) -> SimpleNamespace:
+        return self.append(table, len(dataframe), getattr(job_config, 'write_disposition', None))
+
+    def load_table_from_uri(self, uris: list, table: str, job_config = None) -> SimpleNamespace:
+        rows = 0
+        for uri in uris:
+            bucket_name, name = uri[len('gs://'):].split('/', 1)
+            bucket = self.storage_client.get_bucket(bucket_name)
+            for page in bucket.list_blobs(match_glob= name).pages:
+                for blob in page:
+                    rows += self.count_rows(blob.download_as_bytes())
+        return self.append(table, rows, getattr(job_config, 'write_disposition', None))
+
+    def query(self, sql_query: str) -> SimpleNamespace:
+        return self.append('query', 0)
+
+    def create_table(self, table, exists_ok: bool = False):
+        return table
+
+    def delete_table(self, table, not_found_ok: bool = False):
+        with self.lock:
+            self.tables.pop(table, None)
+
+
+class InMemoryWriteClient:
+    '''
+    Stand-in of google.cloud.bigquery_storage_v1.BigQueryWriteClient, acknowledging every append request.
+    '''
+    def __init__(self):
+        self.rows = 0
+        self.streams = 0
+        self.lock = threading.Lock()
+
+    def create_write_stream(self, parent: str, write_stream = None) -> SimpleNamespace:
+        with self.lock:
+            self.streams += 1
+            return SimpleNamespace(name= f"{parent}/streams/{self.streams}")
+
+    def append_rows(self, requests, metadata = ()):
+        for request in requests:
+            rows = len(request.proto_rows.rows.serialized_rows)
+            with self.lock:
+                self.rows += rows
+            yield SimpleNamespace(
+                error= SimpleNamespace(code= 0, message= ''),
+                row_errors= [],
+                append_result= SimpleNamespace(offset= request.offset)
+            )
+
+    def finalize_write_stream(self, name: str):
+        return SimpleNamespace(row_count= self.rows)
+
+    def batch_commit_write_streams(self, request = None) -> SimpleNamespace:
+        return SimpleNamespace(stream_errors= [])
@@ -0,0 +1,163 @@
+'''
+Offline end to end benchmark of ApiOrquestrator, against the local stand-ins of benchmarks/fakes.py.
+
+Each case (parameter space size x concurrency level) runs in a fresh process, so the peak RSS and the cold imports
+of one case do not leak into the next, and reports requests/s, MB/s, peak RSS and the p50/p95 of each stage.
+A report saved with --output can be given as --baseline of a later run, which fails when a case got slower.
+
+Usage, from the root of the repository:
+    python benchmarks/run_benchmark.py --sizes 8,64 --workers 1,8 --latency-ms 50 --rows 500
+    python benchmarks/run_benchmark.py --output bench.json
+    python benchmarks/run_benchmark.py --baseline bench.json --tolerance 0.2
+'''
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_case(case: dict) -> dict:
+    '''
+    Runs one case of the benchmark in the current process and returns its measures.
+    '''
+    sys.path[:0] = [SRC_DIR, BENCHMARKS_DIR]
+    from fakes import InMemoryBigQueryClient, InMemoryStorageClient, InMemoryWriteClient
+    from classes.client_registry import ClientRegistry
+    from classes.instrumentation import Instrumentation
+    from classes.brasil_api import BrasilApi
+    from classes.api_orquestrator import ApiOrquestrator
+
+    storage_client = InMemoryStorageClient(latency= case['storage_latency_ms'] / 1000)
+    bigquery_client = InMemoryBigQueryClient(storage_client, latency= case['bigquery_latency_ms'] / 1000)
+    ClientRegistry.register_client('storage', storage_client)
+    ClientRegistry.register_client('bigquery', bigquery_client)
+    write_client = InMemoryWriteClient()
+    ClientRegistry.register_client('bigquery_write', write_client)
+    BrasilApi.configure_session(pool_maxsize= max(10, case['workers']))
+    BrasilApi.rate_limiter_options = {'rate' : case['rate'], 'max_rate' : case['rate']}
+
+    folder_name = f"benchmark_{case['size']}_{case['workers']}"
+    orquestrador = ApiOrquestrator(
+        endpoint= "ibge/municipios/v1/",
+        query_parameters= {"providers" : "dados-abertos-br,gov,wikipedia"},
+        path_parameters= [f"P{index:05}" for index in range(case['size'])],
+        bucket= 'brasil_api',
+        download_folder= folder_name,
+        max_workers= case['workers'],
+        api_url= case['api_url'],
+        landing_format= case['landing_format'],
+        sink= case['sink']
+    )
+    Instrumentation.reset()
+    started = time.perf_counter()
+    if case['mode'] == 'pipeline':
+        summary = orquestrador.execute_pipeline()
+    else:
+        summary = orquestrador.execute_requests_envelope_save_file()
+        orquestrador.json_files_to_big_query('brasil_api', folder_name, batch= True, from_uri= case['landing_format'] in ('parquet', 'ndjson.gz'))
+    wall_seconds = time.perf_counter() - started
+
+    stages = Instrumentation.summary()
+    fetched_bytes = stages.get('http_fetch', {}).get('bytes', 0)
+    return {
+        **{key : case[key] for key in ('size', 'workers', 'mode', 'landing_format', 'sink')},
+        'wall_seconds' : round(wall_seconds, 3),
+        'succeeded' : summary['succeeded'],
+        'failed' : summary['failed'],
+        'rows_loaded' : sum(rows for table, rows in bigquery_client.tables.items() if table != 'query') + write_client.rows,
+        'requests_per_second' : round(summary['total'] / wall_seconds, 2),
+        'mb_per_second' : round(fetched_bytes / 1024 / 1024 / wall_seconds, 3),
+        'peak_rss_mb' : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'stages' : {stage : {key : metrics[key] for key in ('count', 'p50_ms', 'p95_ms', 'total_seconds')} for stage, metrics in stages.items()}
+    }
+
+
+def compare(report: list, baseline: list, tolerance: float) -> list:
+    '''
+    Returns the cases of the report whose requests/s fell more than the tolerance below the same case of the baseline.
+    '''
+    def case_key(result):
+        return tuple(result[key] for key in ('size', 'workers', 'mode', 'landing_format', 'sink'))
+    baseline_cases = {case_key(result) : result for result in baseline}
+    regressions = []
+    for result in report:
+        previous = baseline_cases.get(case_key(result))
+        if previous is not None and result['requests_per_second'] < previous['requests_per_second'] * (1 - tolerance):
+            regressions.append({'case' : case_key(result), 'baseline' : previous['requests_per_second'], 'current' : result['requests_per_second']})
+    return regressions
+
+
+def parse_arguments(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description= 'Offline end to end benchmark of ApiOrquestrator.')
+    parser.add_argument('--sizes', default= '8,64', help= 'Comma separated numbers of path parameters requested.')
+    parser.add_argument('--workers', default= '1,8', help= 'Comma separated values of max_workers.')
+    parser.add_argument('--mode', default= 'pipeline', choices= ['pipeline', 'staged'], help= 'execute_pipeline or the requests followed by json_files_to_big_query.')
+    parser.add_argument('--landing-format', default= 'json', choices= ['json', 'ndjson.gz', 'ndjson.zst', 'parquet'])
+    parser.add_argument('--sink', default= 'load_job', choices= ['load_job', 'write_api'])
+    parser.add_argument('--rows', type= int, default= 100, help= 'Municipalities in each response of the fake BrasilAPI.')
+    parser.add_argument('--latency-ms', type= float, default= 50, help= 'Latency of each response of the fake BrasilAPI.')
+    parser.add_argument('--throttle-ratio', type= float, default= 0.0, help= 'Fraction of the requests answered with 429.')
+    parser.add_argument('--storage-latency-ms', type= float, default= 0, help= 'Latency of each Cloud Storage upload and download.')
+    parser.add_argument('--bigquery-latency-ms', type= float, default= 0, help= 'Latency of each BigQuery load job.')
+    parser.add_argument('--rate', type= float, default= 10000, help= 'Requests per second of the client rate limiter.')
+    parser.add_argument('--output', help= 'File where the JSON report is saved.')
+    parser.add_argument('--baseline', help= 'JSON report of a previous run to compare against.')
+    parser.add_argument('--tolerance', type= float, default= 0.2, help= 'Fraction of requests/s that can be lost before a case is a regression.')
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    from fakes import FakeBrasilApiServer
+
+    arguments = parse_arguments(argv)
+    server = FakeBrasilApiServer(rows= arguments.rows, latency= arguments.latency_ms / 1000, throttle_ratio= arguments.throttle_ratio).start()
+    report = []
+    try:
+        sizes = [int(size) for size in arguments.sizes.split(',')]
+        workers = [int(worker) for worker in arguments.workers.split(',')]
+        for size, worker in itertools.product(sizes, workers):
+            case = {
+                'size' : size,
+                'workers' : worker,
+                'mode' : arguments.mode,
+                'landing_format' : arguments.landing_format,
+                'sink' : arguments.sink,
+                'api_url' : server.url,
+                'rate' : arguments.rate,
+                'storage_latency_ms' : arguments.storage_latency_ms,
+                'bigquery_latency_ms' : arguments.bigquery_latency_ms
+            }
+            with ProcessPoolExecutor(max_workers= 1, mp_context= multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_case, case).result()
+            report.append(result)
+            print(f"size={size:<6} workers={worker:<4} {result['requests_per_second']:>9} req/s {result['mb_per_second']:>8} MB/s "
+                  f"{result['peak_rss_mb']:>7} MB rss {result['wall_seconds']:>7} s rows={result['rows_loaded']} failed={result['failed']}")
+            for stage, metrics in result['stages'].items():
+                print(f"    {stage:<15} n={metrics['count']:<6} p50={metrics['p50_ms']:>8} ms p95={metrics['p95_ms']:>8} ms total={metrics['total_seconds']} s")
+    finally:
+        server.stop()
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent= 2)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = compare(report, json.load(file), arguments.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['case']}: {regression['baseline']} -> {regression['current']} req/s")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, BENCHMARKS_DIR)
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from google.api_core.exceptions import GoogleAPIError
+import functools
 import logging
 from logger import trace_id
 
@@ -9,9 +10,10 @@ def decorator_try_except(func):
     This decorator wraps a class method and captures exceptions of type `GoogleAPIError`.
     If an exception occurs, it is logged as an error using the logging library.
     """
-    def try_func(self, *args):
+    @functools.wraps(func)
+    def try_func(self, *args, **kwargs):
         try:
-            return func(self, *args)
+            return func(self, *args, **kwargs)
         except GoogleAPIError as e:
             logging.error(f"ERROR {e}" , extra={"json_fields": trace_id})
     return try_func
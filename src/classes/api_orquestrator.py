@@ -1,12 +1,25 @@
-import pandas as pd
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+import multiprocessing
+import queue
+import threading
 
 from classes.brasil_api import BrasilApi
 from classes.cloud_storage import CloudStorage
 from classes.bigquery import BigQuery
+from classes.ingestion_manifest import IngestionManifest
+from classes.response_cache import ResponseCache
+from classes.schemas import Schemas
 import logging
 from logger import trace_id_value
 from logger import trace_id
 
+# BigQuery accepts at most 10,000 source uris in a single load job
+MAX_URIS_PER_LOAD_JOB = 10000
+# Files loaded one job at a time between two saves of the ingestion manifest, each save rewrites the whole manifest
+MANIFEST_SAVE_FILES = 100
+
 class ApiOrquestrator:
     """
     An API orchestrator class for handling requests, processing responses, and saving data for multiples requests, passing lists on paremeters 
@@ -16,17 +29,63 @@ class ApiOrquestrator:
         path_parameters (list): List of path parameters for API requests (default is [None]).
         token (str): Authentication token for API requests (default is None).
         download_folder (str, optional): The folder where downloaded files will be saved in CloudStorage.
+        max_workers (int, optional): Maximum number of requests in flight at the same time (default is 1, sequential).
+        api_url (str, optional): Base url of the API (default is the BrasilAPI url).
+        response_cache (ResponseCache, optional): Cache of responses, the unchanged ones are not saved again.
+        shard_index (int, optional): Index of the slice of the parameter combinations executed by this instance (default is 0).
+        shard_count (int, optional): Number of disjoint slices the parameter combinations are split into (default is 1).
+        landing_format (str, optional): Format of the files saved in CloudStorage, 'json', 'ndjson.gz', 'ndjson.zst' or 'parquet' (default is 'json').
+        sink (str, optional): How the data is appended to big query, 'load_job' or 'write_api' for the Storage Write API (default is 'load_job').
+        write_mode (str, optional): 'append' to the table, or 'merge' to load into a staging table merged on the natural key
+            of the table into a partitioned and clustered table, keeping reruns idempotent, only with the 'load_job' sink (default is 'append').
     """
-    def __init__(self, endpoint: str, query_parameters: dict, bucket: str, path_parameters: list = [None] ,  token: str = None, download_folder: str = None, trace_id: int = None):
+    def __init__(self, endpoint: str, query_parameters: dict, bucket: str, path_parameters: list = [None] ,  token: str = None, download_folder: str = None, trace_id: int = None, max_workers: int = 1, api_url: str = "https://brasilapi.com.br/api/", response_cache: ResponseCache = None, shard_index: int = 0, shard_count: int = 1, landing_format: str = 'json', sink: str = 'load_job', write_mode: str = 'append'):
         self.endpoint = endpoint
         self.query_parameters = query_parameters
         self.path_parameters = path_parameters
         self.token = token
         self.bucket = bucket
         self.download_folder = download_folder
+        self.max_workers = max(1, int(max_workers))
+        self.api_url = api_url
+        self.response_cache = response_cache
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise ValueError(f'Invalid shard {shard_index} of {shard_count}')
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        if landing_format not in ('json', 'ndjson.gz', 'ndjson.zst', 'parquet'):
+            raise ValueError(f'Unknown landing format {landing_format}')
+        self.landing_format = landing_format
+        if sink not in ('load_job', 'write_api'):
+            raise ValueError(f'Unknown sink {sink}')
+        self.sink = sink
+        if write_mode not in ('append', 'merge'):
+            raise ValueError(f'Unknown write mode {write_mode}')
+        if write_mode == 'merge' and sink == 'write_api':
+            raise ValueError('The merge write mode loads a staging table with load jobs, it can not use the write_api sink')
+        self.write_mode = write_mode
+        self.partitioned_tables = set()
         self.storage_object = CloudStorage()
         self.big_query = BigQuery()
 
+    def iter_query_path_parameters(self):
+        """
+        Lazily generate the combinations of path and query parameters, list values of the query parameters being
+        combined with each other. Only the combinations of the shard of this instance are generated, the combination
+        number i belonging to the shard i % shard_count.
+
+        Yields:
+            dict: Dictionary with 'path' and 'query_parameter' keys.
+        """
+        keys = list(self.query_parameters.keys())
+        values = [value if isinstance(value, list) else [value] for value in self.query_parameters.values()]
+        index = 0
+        for path in self.path_parameters:
+            for combination in itertools.product(*values):
+                if index % self.shard_count == self.shard_index:
+                    yield {'path' : path, 'query_parameter' : dict(zip(keys, combination))}
+                index += 1
+
     def generate_list_query__path_parameters(self) -> list:
         """
         Generate a list of dictionaries with combined query and path parameters.
@@ -34,58 +93,535 @@ class ApiOrquestrator:
         Returns:
             list: A list of dictionaries, each containing 'path' and 'query_parameter' keys.
         """
-        query_parameter = self.query_parameters.copy()
-        for key, value in query_parameter.items():
-            query_parameter[key] = [value] 
-        df_parameters = pd.DataFrame(query_parameter)
-        for column in df_parameters.columns:
-            df_parameters = df_parameters.explode(column)
-        ls_query_parameters = df_parameters.to_dict(orient='records')
-        ls_parameters = []            
-        for path in self.path_parameters:
-            for query in ls_query_parameters:
-                ls_parameters.append( {'path' : path, 'query_parameter' : query} )
-        return ls_parameters
+        return list(self.iter_query_path_parameters())
     
-    def execute_requests_save_file(self):
+    def execute_parameters(self, function) -> dict:
+        """
+        Execute a function for each combination of query and path parameters, isolating the failures of each one.
+        When max_workers is greater than 1 the calls are executed in a thread pool, keeping at most max_workers in flight.
+
+        Args:
+            function (callable): Function receiving a dictionary with 'path' and 'query_parameter' keys.
+
+        Returns:
+            dict: Summary of the execution with the number of requests, successes and the errors of each failed request.
+        """
+        summary = {'trace_id' : trace_id_value, 'total' : 0, 'succeeded' : 0, 'skipped' : 0, 'failed' : 0, 'errors' : []}
+        ls_query_path_parameters = self.iter_query_path_parameters()
+        if self.max_workers == 1:
+            for dict_query_parameters in ls_query_path_parameters:
+                try:
+                    result = function(dict_query_parameters)
+                    self.register_result(summary, dict_query_parameters, skipped= result == 'skipped')
+                except Exception as error:
+                    self.register_result(summary, dict_query_parameters, error)
+        else:
+            with ThreadPoolExecutor(max_workers= self.max_workers) as executor:
+                futures = {}
+                for dict_query_parameters in ls_query_path_parameters:
+                    if len(futures) >= self.max_workers:
+                        done, _ = wait(futures, return_when= FIRST_COMPLETED)
+                        for future in done:
+                            self.register_future(summary, futures.pop(future), future)
+                    futures[executor.submit(function, dict_query_parameters)] = dict_query_parameters
+                for future in futures:
+                    self.register_future(summary, futures[future], future)
+        if summary['failed'] > 0:
+            logging.warning('WARNING Requests executed with failures', extra={"json_fields": summary})
+        else:
+            logging.info('INFO Requests executed with sucess', extra={"json_fields": summary})
+        return summary
+
+    @classmethod
+    def register_future(cls, summary: dict, dict_query_parameters: dict, future):
+        """
+        Register the result of a request executed in the thread pool in the execution summary.
+        """
+        error = future.exception()
+        if error is not None:
+            cls.register_result(summary, dict_query_parameters, error)
+        else:
+            cls.register_result(summary, dict_query_parameters, skipped= future.result() == 'skipped')
+
+    @staticmethod
+    def register_result(summary: dict, dict_query_parameters: dict, error: Exception = None, skipped: bool = False):
+        """
+        Register the result of a single request in the execution summary.
+        A request returning 'skipped' had its response unchanged since the last execution.
+        """
+        summary['total'] += 1
+        if error is None:
+            summary['skipped' if skipped else 'succeeded'] += 1
+            return
+        summary['failed'] += 1
+        summary['errors'].append({
+            'path' : dict_query_parameters['path'],
+            'query_parameter' : dict_query_parameters['query_parameter'],
+            'error' : f'{type(error).__name__}: {error}'
+        })
+        logging.error(f"ERROR Request failed: {error}", extra={"json_fields": trace_id})
+
+    def brasil_api(self, dict_query_parameters: dict) -> BrasilApi:
+        """
+        Create the BrasilApi object of a combination of parameters, its cache entries scoped to the bucket, folder and landing
+        format of the orchestrator, so a cached response only skips the requests saved to the same destination.
+        """
+        return BrasilApi(
+            endpoint= self.endpoint,
+            query_parameter= dict_query_parameters['query_parameter'],
+            path_parameter= dict_query_parameters['path'],
+            url= self.api_url,
+            cache= self.response_cache,
+            cache_scope= f"gs://{self.bucket}/{self.download_folder or ''}|{self.landing_format}"
+        )
+
+    def request_save_file(self, dict_query_parameters: dict):
+        """
+        Execute a single API request and save the response to a JSON file.
+        """
+        obj_brasil_api = self.brasil_api(dict_query_parameters)
+        response = obj_brasil_api.request_get()
+        if response.not_modified:
+            return 'skipped'
+        name_file = obj_brasil_api.generate_name_file()
+        if self.storage_object.request_to_json_file(self.bucket, response, name_file, self.download_folder) is None:
+            raise RuntimeError(f'Upload of {name_file} to Cloud Storage failed')
+        obj_brasil_api.commit_cache(response)
+
+    def request_envelope_save_file(self, dict_query_parameters: dict):
+        """
+        Execute a single API request, envelope the response and save it to a JSON file.
+        """
+        obj_brasil_api = self.brasil_api(dict_query_parameters)
+        response = obj_brasil_api.request_get(stream= self.response_cache is None and self.landing_format == 'json')
+        if response.not_modified:
+            return 'skipped'
+        envelope = obj_brasil_api.generate_envelope()
+        json_payload ={'trace_id' : trace_id_value, 'content' : envelope['envelope']}
+        logging.info('Executing Requests with envelope and save file in cloud storage', extra={"json_fields": json_payload})
+        self.save_landing_file(obj_brasil_api, response, envelope)
+
+    def save_landing_file(self, obj_brasil_api: BrasilApi, response, envelope: dict, json_content: dict = None, commit_cache: bool = True):
+        """
+        Save an API response with its envelope to CloudStorage in the landing format, storing it in the response cache afterwards.
+        The JSON format streams the raw body, the other formats use the parsed content, parsed here when not given.
+        Without commit_cache the caller stores the response in the cache, once the data is also loaded downstream.
+
+        Returns:
+            dict: The metadata of the uploaded blob, as listed by CloudStorage.list_objects_pages.
+        """
+        name_file = obj_brasil_api.generate_name_file()
+        if self.landing_format == 'json':
+            blob_item = self.storage_object.request_to_json_envelope_file(self.bucket, response, name_file, envelope, self.download_folder)
+        else:
+            if json_content is None:
+                json_content = {'envelope' : envelope['envelope'], 'content' : response.json()}
+            blob_item = self.storage_object.json_envelope_to_landing_file(self.bucket, json_content, name_file, self.download_folder, self.landing_format)
+        if blob_item is None:
+            raise RuntimeError(f'Upload of {name_file} to Cloud Storage failed')
+        if commit_cache:
+            obj_brasil_api.commit_cache(response)
+        return blob_item
+
+    def landing_blob_name(self, obj_brasil_api: BrasilApi) -> str:
+        """
+        Returns the name of the blob where the response of a request is saved in the landing format.
+        """
+        name_file = obj_brasil_api.generate_name_file()
+        if self.landing_format != 'json':
+            name_file = CloudStorage.landing_name_file(name_file, self.landing_format)
+        if self.download_folder is not None:
+            name_file = f"{self.download_folder}/{name_file}"
+        return name_file
+
+    def execute_requests_save_file(self) -> dict:
         """
         Execute API requests, save responses to JSON files.
+
+        Returns:
+            dict: Summary of the execution.
         """
-        ls_query_path_parameters = self.generate_list_query__path_parameters()
-        for dict_query_parameters in ls_query_path_parameters:
-            obj_brasil_api = BrasilApi(
-                endpoint= self.endpoint,
-                query_parameter= dict_query_parameters['query_parameter'],
-                path_parameter= dict_query_parameters['path'] 
-            )
-            response = obj_brasil_api.request_get()
-            name_file = obj_brasil_api.generate_name_file()
-            self.storage_object.request_to_json_file(self.bucket, response, name_file, self.download_folder)
+        return self.execute_parameters(self.request_save_file)
 
-    def execute_requests_envelope_save_file(self):
+    def execute_requests_envelope_save_file(self) -> dict:
         """
         Execute API requests, envelope responses, and save to JSON files.
+
+        Returns:
+            dict: Summary of the execution.
+        """
+        return self.execute_parameters(self.request_envelope_save_file)
+
+    def request_envelope_to_queue(self, dict_query_parameters: dict, upload_queue: queue.Queue, obj_manifest: IngestionManifest = None):
+        """
+        Execute a single API request, envelope the response and put it in the queue of the upload stage.
+        The response is stored in the cache by the load stage, after it was saved and loaded.
+        With a manifest, the request is skipped when its blob was already loaded.
+        """
+        obj_brasil_api = self.brasil_api(dict_query_parameters)
+        if obj_manifest is not None and obj_manifest.has_file(self.landing_blob_name(obj_brasil_api)):
+            return 'skipped'
+        response = obj_brasil_api.request_get()
+        if response.not_modified:
+            return 'skipped'
+        envelope = obj_brasil_api.generate_envelope()
+        json_content = {'envelope' : envelope['envelope'], 'content' : response.json()}
+        upload_queue.put((obj_brasil_api, response, envelope, json_content))
+
+    def execute_pipeline(self, dataset_name: str = 'brasil_api', table_name: str = 'municipios', queue_size: int = None, max_bytes_per_job: int = 256 * 1024 * 1024, manifest: bool = False) -> dict:
         """
-        ls_query_path_parameters = self.generate_list_query__path_parameters()
-        for dict_query_parameters in ls_query_path_parameters:
-            obj_brasil_api = BrasilApi(
-                endpoint= self.endpoint,
-                query_parameter= dict_query_parameters['query_parameter'],
-                path_parameter= dict_query_parameters['path'] 
-            )
-            response = obj_brasil_api.request_get()
-            envelope = obj_brasil_api.generate_envelope()
-            name_file = obj_brasil_api.generate_name_file()
-            json_payload ={'trace_id' : trace_id_value, 'content' : envelope['envelope']}
-            print(json_payload)
-            logging.info('Executing Requests with envelope and save file in cloud storage', extra={"json_fields": json_payload})
-            self.storage_object.request_to_json_envelope_file(self.bucket, response, name_file, envelope, self.download_folder)
-
-    def json_files_to_big_query(self, bucket_name: str, folder_name: str):
+        Execute API requests, save the enveloped responses to JSON files and load them into big query as a pipeline.
+        The fetch, upload and load stages run at the same time, connected by bounded queues, and each response is
+        loaded from memory instead of being downloaded again from Cloud Storage.
+        With the manifest, the uploaded blobs are registered in the ingestion manifest of the download folder after each
+        load job, the same one of json_files_to_big_query, and the requests of the blobs already registered are skipped,
+        so a retried execution does not load the same data again. The responses are stored in the response cache only
+        after their load job (and the save of the manifest) succeeded, so a failed load is fetched again by the next execution.
+
+        Args:
+            dataset_name (str, optional): The name of the dataset.
+            table_name (str, optional): The name of the table.
+            queue_size (int, optional): Maximum number of items waiting between two stages (default is twice max_workers).
+            max_bytes_per_job (int, optional): In memory size of the buffered data that starts a load job when crossed.
+            manifest (bool, optional): Use the ingestion manifest of the download folder, a folder is then required (default is False).
+
+        Returns:
+            dict: Summary of the execution, with the counters of each stage, the requests whose upload or load failed
+                are also counted in 'failed'.
+        """
+        queue_size = queue_size or self.max_workers * 2
+        table_id = f"{dataset_name}.{table_name}"
+        obj_manifest = self.folder_manifest(self.bucket, self.download_folder, table_id) if manifest else None
+        upload_queue = queue.Queue(maxsize= queue_size)
+        load_queue = queue.Queue(maxsize= queue_size)
+        summary_lock = threading.Lock()
+        summary_stages = {'uploaded' : 0, 'upload_failed' : 0, 'rows_loaded' : 0, 'load_jobs' : 0, 'load_failed' : 0, 'load_failed_files' : 0}
+
+        def upload_stage():
+            while True:
+                item = upload_queue.get()
+                if item is None:
+                    return
+                obj_brasil_api, response, envelope, json_content = item
+                try:
+                    blob_item = self.save_landing_file(obj_brasil_api, response, envelope, json_content, commit_cache= False)
+                    arrow_table = CloudStorage.envelope_to_arrow_table(json_content, table_id)
+                except Exception as error:
+                    logging.error(f"ERROR Upload stage failed: {error}", extra={"json_fields": trace_id})
+                    with summary_lock:
+                        summary_stages['upload_failed'] += 1
+                    continue
+                with summary_lock:
+                    summary_stages['uploaded'] += 1
+                load_queue.put((arrow_table, blob_item, obj_brasil_api, response))
+
+        def load_stage():
+            ls_tables = []
+            ls_items = []
+            ls_responses = []
+            bytes_buffered = 0
+            while True:
+                item = load_queue.get()
+                if item is not None:
+                    ls_tables.append(item[0])
+                    ls_items.append(item[1])
+                    ls_responses.append((item[2], item[3]))
+                    bytes_buffered += item[0].nbytes
+                if ls_tables and (item is None or bytes_buffered >= max_bytes_per_job):
+                    rows = sum(arrow_table.num_rows for arrow_table in ls_tables)
+                    try:
+                        self.load_big_query(dataset_name, table_name, ls_tables)
+                        summary_stages['rows_loaded'] += rows
+                        summary_stages['load_jobs'] += 1
+                        loaded = True
+                    except Exception as error:
+                        logging.error(f"ERROR Load stage failed: {error}", extra={"json_fields": trace_id})
+                        summary_stages['load_failed'] += rows
+                        summary_stages['load_failed_files'] += len(ls_items)
+                        loaded = False
+                    if loaded and obj_manifest is not None:
+                        try:
+                            obj_manifest.mark_loaded(ls_items)
+                            obj_manifest.save()
+                        except Exception as error:
+                            logging.error(f"ERROR Manifest of the load stage could not be saved: {error}", extra={"json_fields": trace_id})
+                            loaded = False
+                    if loaded:
+                        try:
+                            for obj_brasil_api, response in ls_responses:
+                                obj_brasil_api.commit_cache(response)
+                        except Exception as error:
+                            logging.error(f"ERROR Responses of the load stage could not be cached: {error}", extra={"json_fields": trace_id})
+                    ls_tables = []
+                    ls_items = []
+                    ls_responses = []
+                    bytes_buffered = 0
+                if item is None:
+                    return
+
+        upload_threads = [threading.Thread(target= upload_stage) for _ in range(self.max_workers)]
+        load_thread = threading.Thread(target= load_stage)
+        for thread in upload_threads + [load_thread]:
+            thread.start()
+        try:
+            summary = self.execute_parameters(lambda dict_query_parameters: self.request_envelope_to_queue(dict_query_parameters, upload_queue, obj_manifest))
+        finally:
+            for _ in upload_threads:
+                upload_queue.put(None)
+            for thread in upload_threads:
+                thread.join()
+            load_queue.put(None)
+            load_thread.join()
+        summary.update(summary_stages)
+        summary['failed'] += summary_stages['upload_failed'] + summary_stages['load_failed_files']
+        if summary['failed'] > 0:
+            logging.warning('WARNING Pipeline executed with failures', extra={"json_fields": summary})
+        else:
+            logging.info('INFO Pipeline executed', extra={"json_fields": summary})
+        return summary
+
+    def json_files_to_big_query(self, bucket_name: str, folder_name: str, batch: bool = False, max_bytes_per_job: int = 256 * 1024 * 1024, manifest: bool = False, from_uri: bool = False):
         '''
         Open Json files from CloudStorage and save into big query
+
+        Args:
+            bucket_name (str): The name of the bucket.
+            folder_name (str): The folder with the json files.
+            batch (bool, optional): Load all the files with a single job instead of one job per file (default is False).
+            max_bytes_per_job (int, optional): On batch mode, size of the data that starts a new load job when crossed.
+            manifest (bool, optional): Skip the files already loaded, registering the loaded ones in the ingestion manifest of the folder,
+                a folder is then required (default is False). The manifest is saved after each load job on batch mode,
+                otherwise every MANIFEST_SAVE_FILES files, and at the end of the folder.
+            from_uri (bool, optional): Let big query read the files of the landing format directly from CloudStorage,
+                without downloading them, only for the 'parquet' and 'ndjson.gz' formats (default is False).
+        '''
+        obj_manifest = None
+        if manifest:
+            obj_manifest = self.folder_manifest(bucket_name, folder_name)
+        match_glob = f"**.{self.landing_format}" if from_uri else None
+        ls_data = []
+        ls_items = []
+        bytes_buffered = 0
+        try:
+            for page in self.landing_pages(bucket_name, folder_name, match_glob):
+                for item in page:
+                    if obj_manifest is not None and obj_manifest.is_loaded(item):
+                        continue
+                    if from_uri:
+                        ls_data.append(f"gs://{bucket_name}/{item['name']}")
+                        bytes_buffered += item['size'] or 0
+                    else:
+                        arrow_table = self.storage_object.landing_file_to_arrow_table(bucket_name, item['name'])
+                        if arrow_table is None:
+                            raise RuntimeError(f"Download of {item['name']} from Cloud Storage failed")
+                        logging.info(f'Opening json file: {folder_name} with envelope and save file in bigquery' , extra={"json_fields": trace_id})
+                        ls_data.append(arrow_table)
+                        bytes_buffered += arrow_table.nbytes
+                    ls_items.append(item)
+                    if not batch or bytes_buffered >= max_bytes_per_job or len(ls_data) >= MAX_URIS_PER_LOAD_JOB:
+                        self.insert_files_big_query(ls_data, ls_items, obj_manifest, from_uri)
+                        if obj_manifest is not None and (batch or len(obj_manifest.pending) >= MANIFEST_SAVE_FILES):
+                            obj_manifest.save()
+                        ls_data = []
+                        ls_items = []
+                        bytes_buffered = 0
+            if ls_data:
+                self.insert_files_big_query(ls_data, ls_items, obj_manifest, from_uri)
+        finally:
+            if obj_manifest is not None and obj_manifest.pending:
+                obj_manifest.save()
+
+    def landing_pages(self, bucket_name: str, folder_name: str = None, match_glob: str = None):
+        '''
+        Lazily list the landing files of a folder page by page, leaving out the ingestion manifests stored in the same bucket.
+        '''
+        for page in self.storage_object.list_objects_pages(bucket_name, folder_name, match_glob= match_glob):
+            yield [item for item in page if not item['name'].startswith(IngestionManifest.prefix)]
+
+    def folder_manifest(self, bucket_name: str, folder_name: str, table_id: str = 'brasil_api.municipios') -> IngestionManifest:
+        '''
+        Load the ingestion manifest of the files of a folder loaded into a table.
+        A folder is required, the manifest of the root of the bucket would be listed with the landing files and loaded as one of them.
+        '''
+        if not folder_name:
+            raise ValueError('The ingestion manifest needs a folder')
+        obj_manifest = IngestionManifest(self.storage_object, bucket_name, f"{IngestionManifest.prefix}{table_id}/{folder_name}.json")
+        obj_manifest.load()
+        return obj_manifest
+
+    def insert_files_big_query(self, ls_data: list, ls_items: list, obj_manifest: IngestionManifest = None, from_uri: bool = False):
+        '''
+        Load a group of files into big query with a single job, registering the files in the manifest after the load.
+        The manifest is not saved here, the caller saves it once per group of loads.
+        The data is a list of pyarrow.Table, or of gs:// uris when from_uri is True.
+        '''
+        self.load_big_query('brasil_api', 'municipios', ls_data, from_uri)
+        if obj_manifest is not None:
+            obj_manifest.mark_loaded(ls_items)
+
+    @staticmethod
+    def backfill_folders(start_date, end_date, date_format: str = '%Y-%m-%d') -> list:
+        """
+        Returns the folders of each day of a date range, both ends included.
+
+        Args:
+            start_date (date or str): First day, a str in the date_format.
+            end_date (date or str): Last day, a str in the date_format.
+            date_format (str, optional): strftime format of the folder names, e.g. 'municipios/%Y/%m/%d' (default is '%Y-%m-%d').
+        """
+        if isinstance(start_date, str):
+            start_date = datetime.strptime(start_date, date_format).date()
+        if isinstance(end_date, str):
+            end_date = datetime.strptime(end_date, date_format).date()
+        days = (end_date - start_date).days
+        return [(start_date + timedelta(days= day)).strftime(date_format) for day in range(days + 1)]
+
+    def download_landing_file(self, bucket_name: str, item: dict, table_id: str, parse_pool: ProcessPoolExecutor = None):
+        """
+        Download a landing file and convert it to a pyarrow.Table, parsing it in the process pool when given.
+        """
+        file_bytes = self.storage_object.download_file_bytes(bucket_name, item['name'])
+        if file_bytes is None:
+            raise RuntimeError(f"Download of {item['name']} from Cloud Storage failed")
+        if parse_pool is None:
+            return CloudStorage.landing_bytes_to_arrow_table(item['name'], file_bytes, table_id)
+        return parse_pool.submit(CloudStorage.landing_bytes_to_arrow_table, item['name'], file_bytes, table_id).result()
+
+    def execute_backfill(self, bucket_name: str, folders: list = None, start_date = None, end_date = None, date_format: str = '%Y-%m-%d', dataset_name: str = 'brasil_api', table_name: str = 'municipios', max_download_workers: int = 16, max_parse_workers: int = None, memory_budget: int = 256 * 1024 * 1024, max_bytes_per_job: int = None) -> dict:
+        """
+        Reload landed folders of CloudStorage into big query, for backfills and rebuilds of the table.
+        The files of each folder are downloaded by a pool of threads, parsed to pyarrow.Table in a pool of processes and
+        loaded in chunks of max_bytes_per_job. The files being downloaded and the tables buffered until their load share
+        the memory budget, and a load job copies its chunk about twice more while serializing it, so the peak memory
+        is close to memory_budget + 2 * max_bytes_per_job.
+        Each chunk is registered in the ingestion manifest of its folder after the load, the same one of json_files_to_big_query,
+        so an interrupted backfill executed again resumes from the files not loaded yet.
+
+        Args:
+            bucket_name (str): The name of the bucket.
+            folders (list, optional): The folders to be loaded, instead of a date range.
+            start_date (date or str, optional): First day of the folders to be loaded.
+            end_date (date or str, optional): Last day of the folders to be loaded (default is start_date).
+            date_format (str, optional): strftime format of the folder names of the date range (default is '%Y-%m-%d').
+            dataset_name (str, optional): The name of the dataset.
+            table_name (str, optional): The name of the table.
+            max_download_workers (int, optional): Maximum number of files downloaded at the same time.
+            max_parse_workers (int, optional): Number of processes parsing the files (default is the number of CPUs), 0 parses them in the download threads.
+            memory_budget (int, optional): Maximum size of the files being downloaded and of the tables not loaded yet, a larger file is downloaded alone.
+            max_bytes_per_job (int, optional): In memory size of the buffered data that starts a load job when crossed (default is a quarter of the memory budget).
+
+        Returns:
+            dict: Summary of the execution, with the counters of files and the errors.
+        """
+        if folders is None:
+            if start_date is None:
+                raise ValueError('A backfill needs a list of folders or a date range')
+            folders = self.backfill_folders(start_date, end_date or start_date, date_format)
+        if max_bytes_per_job is None:
+            max_bytes_per_job = memory_budget // 4
+        table_id = f"{dataset_name}.{table_name}"
+        summary = {'trace_id' : trace_id_value, 'folders' : len(folders), 'files' : 0, 'loaded' : 0, 'skipped' : 0, 'failed' : 0, 'rows_loaded' : 0, 'load_jobs' : 0, 'load_failed' : 0, 'errors' : []}
+        parse_pool = None
+        if max_parse_workers != 0:
+            parse_pool = ProcessPoolExecutor(max_workers= max_parse_workers, mp_context= multiprocessing.get_context('spawn'))
+        download_pool = ThreadPoolExecutor(max_workers= max_download_workers)
+        try:
+            for folder_name in folders:
+                obj_manifest = self.folder_manifest(bucket_name, folder_name, table_id)
+                futures = {}
+                buffer = {'tables' : [], 'items' : [], 'bytes' : 0, 'in_flight' : 0}
+
+                def flush():
+                    try:
+                        self.load_big_query(dataset_name, table_name, buffer['tables'])
+                        obj_manifest.mark_loaded(buffer['items'])
+                        obj_manifest.save()
+                        summary['load_jobs'] += 1
+                        summary['loaded'] += len(buffer['items'])
+                        summary['rows_loaded'] += sum(arrow_table.num_rows for arrow_table in buffer['tables'])
+                    except Exception as error:
+                        summary['load_failed'] += 1
+                        summary['errors'].append({'folder' : folder_name, 'files' : len(buffer['items']), 'error' : repr(error)})
+                        logging.error(f'ERROR Backfill load of {folder_name} failed: {error}', extra={"json_fields": trace_id})
+                    buffer.update({'tables' : [], 'items' : [], 'bytes' : 0})
+
+                def collect(done):
+                    for future in done:
+                        item = futures.pop(future)
+                        buffer['in_flight'] -= item['size'] or 0
+                        try:
+                            arrow_table = future.result()
+                        except Exception as error:
+                            summary['failed'] += 1
+                            summary['errors'].append({'file' : item['name'], 'error' : repr(error)})
+                            logging.error(f"ERROR Backfill of {item['name']} failed: {error}", extra={"json_fields": trace_id})
+                            continue
+                        buffer['tables'].append(arrow_table)
+                        buffer['items'].append(item)
+                        buffer['bytes'] += arrow_table.nbytes
+                        if buffer['bytes'] >= max_bytes_per_job:
+                            flush()
+
+                for page in self.landing_pages(bucket_name, folder_name):
+                    for item in page:
+                        summary['files'] += 1
+                        if obj_manifest.is_loaded(item):
+                            summary['skipped'] += 1
+                            continue
+                        while buffer['in_flight'] + buffer['bytes'] + (item['size'] or 0) > memory_budget:
+                            if futures:
+                                done, _ = wait(futures, return_when= FIRST_COMPLETED)
+                                collect(done)
+                            elif buffer['tables']:
+                                flush()
+                            else:
+                                break
+                        buffer['in_flight'] += item['size'] or 0
+                        futures[download_pool.submit(self.download_landing_file, bucket_name, item, table_id, parse_pool)] = item
+                collect(wait(futures).done)
+                if buffer['tables']:
+                    flush()
+                logging.info(f'INFO Backfill of {folder_name} finished', extra={"json_fields": {**trace_id, 'loaded' : summary['loaded'], 'skipped' : summary['skipped']}})
+        finally:
+            download_pool.shutdown(wait= True, cancel_futures= True)
+            if parse_pool is not None:
+                parse_pool.shutdown(wait= True, cancel_futures= True)
+        if summary['failed'] or summary['load_failed']:
+            logging.warning(f"WARNING Backfill with {summary['failed']} files and {summary['load_failed']} loads failed", extra={"json_fields": summary})
+        else:
+            logging.info('INFO Backfill executed', extra={"json_fields": summary})
+        return summary
+
+    def load_big_query(self, dataset_name: str, table_name: str, ls_data: list, from_uri: bool = False):
+        '''
+        Load a group of pyarrow.Table, or of gs:// uris when from_uri is True, into big query following the write mode.
+        On the append mode the data is appended with the sink of the orchestrator, a load job or the Storage Write API.
+        On the merge mode the data is loaded into a staging table of the execution, merged into the partitioned table
+        and the staging table is deleted.
         '''
-        for item in self.storage_object.list_objects_buckets(bucket_name, folder_name):
-            df = self.storage_object.json_envelope_to_dataframe(bucket_name, item)
-            logging.info(f'Opening json file: {folder_name} with envelope and save file in bigquery' , extra={"json_fields": trace_id})
-            self.big_query.insert_dataframe_append('brasil_api', 'municipios', df)
\ No newline at end of file
+        table_id = f"{dataset_name}.{table_name}"
+        if self.write_mode == 'append':
+            if from_uri:
+                self.big_query.insert_uri_append(dataset_name, table_name, ls_data, self.landing_format, schema= Schemas.bigquery_schema(table_id))
+            elif self.sink == 'write_api':
+                self.big_query.insert_arrow_write_api(dataset_name, table_name, ls_data, Schemas.fields(table_id))
+            else:
+                self.big_query.insert_arrow_append(dataset_name, table_name, ls_data, Schemas.bigquery_schema(table_id))
+            return
+        if Schemas.key(table_id) is None:
+            raise ValueError(f'The merge write mode needs a declared schema for {table_id}')
+        if table_id not in self.partitioned_tables:
+            if self.big_query.create_partitioned_table(dataset_name, table_name, Schemas.bigquery_schema(table_id), clustering_fields= Schemas.clustering(table_id)) is None:
+                raise RuntimeError(f'Partitioned table {table_id} could not be created')
+            self.partitioned_tables.add(table_id)
+        staging_table_name = f"{table_name}_staging_{trace_id_value}"
+        try:
+            if from_uri:
+                self.big_query.insert_uri_append(dataset_name, staging_table_name, ls_data, self.landing_format, 'WRITE_TRUNCATE', Schemas.bigquery_schema(table_id))
+            else:
+                self.big_query.insert_arrow_append(dataset_name, staging_table_name, ls_data, Schemas.bigquery_schema(table_id), 'WRITE_TRUNCATE')
+            columns = [name for name, _ in Schemas.fields(table_id)]
+            filter_columns = [column for column in Schemas.clustering(table_id) or [] if column in Schemas.key(table_id)]
+            self.big_query.merge_staging_table(dataset_name, table_name, staging_table_name, columns, Schemas.key(table_id), filter_columns= filter_columns)
+        finally:
+            self.big_query.delete_table(dataset_name, staging_table_name, not_found_ok= True)
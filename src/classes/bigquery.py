@@ -1,16 +1,47 @@
-from google.cloud import bigquery
+from __future__ import annotations
+from typing import TYPE_CHECKING
 from google.api_core.exceptions import GoogleAPIError
-import pandas as pd
+import io
+import threading
 import logging
 from classes.all import decorator_try_except
+from classes.client_registry import ClientRegistry
+from classes.instrumentation import Instrumentation
 from logger import trace_id
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from google.cloud import bigquery
+
 class BigQuery:
     """
     A class for interacting with Google BigQuery using the Python client library.
+    Data can be appended with load jobs (insert_*_append) or streamed with the Storage Write API (insert_arrow_write_api).
     """
-    def __init__(self):
-        self.client = bigquery.Client()
+    proto_types = {
+        'STRING' : 'TYPE_STRING',
+        'INTEGER' : 'TYPE_INT64',
+        'FLOAT' : 'TYPE_DOUBLE',
+        'BOOLEAN' : 'TYPE_BOOL'
+    }
+    proto_messages = {}
+    proto_lock = threading.Lock()
+    write_api_tables = set()
+    write_api_lock = threading.Lock()
+
+    @property
+    def client(self) -> bigquery.Client:
+        """
+        The google.cloud.bigquery client shared by the process, created on first use.
+        """
+        return ClientRegistry.bigquery_client()
+
+    @property
+    def write_client(self):
+        """
+        The BigQuery Storage Write API client shared by the process, created on first use.
+        """
+        return ClientRegistry.bigquery_write_client()
 
     @decorator_try_except
     def select(self, sql_query: str) ->pd.DataFrame:
@@ -37,17 +68,18 @@ class BigQuery:
         self.client.create_dataset(dataset_name)
         logging.info('INFO DataSet created with sucess'  , extra={"json_fields": trace_id})
 
-    def delete_table(self, dataset_name: str, table_name: str):
+    def delete_table(self, dataset_name: str, table_name: str, not_found_ok: bool = False):
         """
         Delete a table in a BigQuery dataset.
 
         Args:
             dataset_name (str): The name of the dataset.
             table_name (str): The name of the table to be deleted.
+            not_found_ok (bool, optional): Do not fail when the table does not exist.
         """
         dataset = self.client.dataset(dataset_name)
         table = dataset.table(table_name)
-        self.client.delete_table(table)
+        self.client.delete_table(table, not_found_ok= not_found_ok)
         logging.info('INFO Table Deleted with Sucess'  , extra={"json_fields": trace_id})
 
     def insert_dataframe_append(self, dataset_name: str, table_name: str, dataframe: str):
@@ -60,6 +92,279 @@ class BigQuery:
         """
         dataset = self.client.dataset(dataset_name)
         table = dataset.table(table_name)
-        job = self.client.load_table_from_dataframe(dataframe, table)
-        job.result()
-        logging.info('INFO Dataframe append with sucess'  , extra={"json_fields": trace_id})
\ No newline at end of file
+        with Instrumentation.span('bigquery_load') as span:
+            job = self.client.load_table_from_dataframe(dataframe, table)
+            job.result()
+            span['rows'] = len(dataframe)
+        logging.info('INFO Dataframe append with sucess'  , extra={"json_fields": trace_id})
+
+    def insert_uri_append(self, dataset_name: str, table_name: str, uris: list, source_format: str, write_disposition: str = 'WRITE_APPEND', schema: list = None):
+        """
+        Append data from files in Cloud Storage to a BigQuery table using a single load job, read natively by BigQuery.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the table.
+            uris (list): The gs:// uris of the files, wildcards are accepted.
+            source_format (str): The landing format of the files, 'parquet' or 'ndjson.gz'.
+            write_disposition (str, optional): 'WRITE_APPEND' or 'WRITE_TRUNCATE' to replace the data of the table.
+            schema (list, optional): The bigquery.SchemaField of the table, required by newline delimited JSON when the table does not exist.
+        """
+        bigquery = ClientRegistry.import_module('google.cloud.bigquery')
+        source_formats = {
+            'parquet' : bigquery.SourceFormat.PARQUET,
+            'ndjson.gz' : bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        }
+        if source_format not in source_formats:
+            raise ValueError(f'BigQuery can not load {source_format} files from Cloud Storage')
+        dataset = self.client.dataset(dataset_name)
+        table = dataset.table(table_name)
+        job_config = bigquery.LoadJobConfig(
+            source_format= source_formats[source_format],
+            write_disposition= write_disposition,
+            schema= schema
+        )
+        with Instrumentation.span('bigquery_load') as span:
+            job = self.client.load_table_from_uri(uris, table, job_config= job_config)
+            job.result()
+            span['rows'] = job.output_rows or 0
+            span['bytes'] = job.input_file_bytes or 0
+        logging.info('INFO Files from Cloud Storage append with sucess'  , extra={"json_fields": trace_id})
+
+    def insert_arrow_append(self, dataset_name: str, table_name: str, arrow_tables: list, schema: list = None, write_disposition: str = 'WRITE_APPEND'):
+        """
+        Append data from a list of pyarrow.Table to a BigQuery table using a single load job, sent as a Parquet file.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the table.
+            arrow_tables (list): List of pyarrow.Table with the same schema.
+            schema (list, optional): The bigquery.SchemaField of the table, so the types are not inferred on each load.
+            write_disposition (str, optional): 'WRITE_APPEND' or 'WRITE_TRUNCATE' to replace the data of the table.
+        """
+        bigquery = ClientRegistry.import_module('google.cloud.bigquery')
+        pa = ClientRegistry.import_module('pyarrow')
+        pq = ClientRegistry.import_module('pyarrow.parquet')
+        buffer = io.BytesIO()
+        arrow_table = pa.concat_tables(arrow_tables)
+        pq.write_table(arrow_table, buffer)
+        buffer.seek(0)
+        dataset = self.client.dataset(dataset_name)
+        table = dataset.table(table_name)
+        job_config = bigquery.LoadJobConfig(
+            source_format= bigquery.SourceFormat.PARQUET,
+            write_disposition= write_disposition,
+            schema= schema
+        )
+        with Instrumentation.span('bigquery_load') as span:
+            job = self.client.load_table_from_file(buffer, table, job_config= job_config)
+            job.result()
+            span['rows'] = arrow_table.num_rows
+            span['bytes'] = buffer.getbuffer().nbytes
+        logging.info('INFO Arrow tables append with sucess'  , extra={"json_fields": trace_id})
+
+    @decorator_try_except
+    def create_partitioned_table(self, dataset_name: str, table_name: str, schema: list, partition_field: str = 'ingestion_date', clustering_fields: list = None):
+        """
+        Create a table partitioned by day on a DATE column and clustered, when it does not exist yet.
+        The partition column is added to the schema when missing. An existing table must already be partitioned
+        on the same column and have all the columns of the schema, otherwise a ValueError is raised.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the table.
+            schema (list): The bigquery.SchemaField of the table.
+            partition_field (str, optional): The DATE column of the partitions (default is 'ingestion_date').
+            clustering_fields (list, optional): Up to four columns used to cluster the data inside each partition.
+        """
+        bigquery = ClientRegistry.import_module('google.cloud.bigquery')
+        schema = list(schema)
+        if partition_field not in [field.name for field in schema]:
+            schema.append(bigquery.SchemaField(partition_field, 'DATE'))
+        table_id = f"{self.client.project}.{dataset_name}.{table_name}"
+        table = bigquery.Table(table_id, schema= schema)
+        table.time_partitioning = bigquery.TimePartitioning(type_= bigquery.TimePartitioningType.DAY, field= partition_field)
+        table.clustering_fields = clustering_fields
+        self.client.create_table(table, exists_ok= True)
+        table = self.client.get_table(table_id)
+        if table.time_partitioning is None or table.time_partitioning.field != partition_field:
+            raise ValueError(f'Table {dataset_name}.{table_name} already exists without partitions on {partition_field}, use another table or recreate it')
+        existing_columns = {field.name for field in table.schema}
+        missing_columns = [field.name for field in schema if field.name not in existing_columns]
+        if missing_columns:
+            raise ValueError(f'Table {dataset_name}.{table_name} already exists without the columns {", ".join(missing_columns)}')
+        logging.info('INFO Partitioned table available'  , extra={"json_fields": trace_id})
+        return table_name
+
+    def merge_staging_table(self, dataset_name: str, table_name: str, staging_table_name: str, columns: list, key_columns: list, partition_field: str = 'ingestion_date', filter_columns: list = None):
+        """
+        Merge the rows of a staging table into a table on a natural key, so loading the same data again does not duplicate it.
+        New keys are inserted with the current date in the partition column, existing keys are updated only when a value changed,
+        and duplicated keys in the staging table are reduced to one row, the first one in the order of the values.
+        The target rows are restricted to the values of the filter columns present in the staging table, so a target
+        clustered on them only reads the blocks of those values instead of the whole table.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the target table.
+            staging_table_name (str): The name of the staging table, with the same columns.
+            columns (list): The names of the columns to be merged.
+            key_columns (list): The names of the columns of the natural key.
+            partition_field (str, optional): The DATE column of the partitions of the target table.
+            filter_columns (list, optional): Columns of the natural key, usually the clustering fields, whose values restrict the target rows.
+        """
+        value_columns = [column for column in columns if column not in key_columns]
+        staging_table_id = f"{self.client.project}.{dataset_name}.{staging_table_name}"
+        conditions = [f"target.{column} IS NOT DISTINCT FROM source.{column}" for column in key_columns]
+        for column in filter_columns or []:
+            conditions.append(
+                f"(target.{column} IN (SELECT DISTINCT {column} FROM `{staging_table_id}` WHERE {column} IS NOT NULL)"
+                f" OR (target.{column} IS NULL AND EXISTS (SELECT 1 FROM `{staging_table_id}` WHERE {column} IS NULL)))"
+            )
+        sql_query = f"""
+            MERGE `{self.client.project}.{dataset_name}.{table_name}` AS target
+            USING (
+                SELECT {", ".join(columns)}
+                FROM `{staging_table_id}`
+                WHERE TRUE
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY {", ".join(key_columns)} ORDER BY {", ".join(value_columns or key_columns)}) = 1
+            ) AS source
+            ON {" AND ".join(conditions)}
+        """
+        if value_columns:
+            changed = " OR ".join(f"target.{column} IS DISTINCT FROM source.{column}" for column in value_columns)
+            updates = ", ".join(f"{column} = source.{column}" for column in value_columns)
+            sql_query += f"""
+            WHEN MATCHED AND ({changed}) THEN
+                UPDATE SET {updates}
+            """
+        sql_query += f"""
+            WHEN NOT MATCHED THEN
+                INSERT ({", ".join(columns)}, {partition_field})
+                VALUES ({", ".join(f"source.{column}" for column in columns)}, CURRENT_DATE())
+        """
+        with Instrumentation.span('bigquery_merge') as span:
+            query_job = self.client.query(sql_query)
+            query_job.result()
+            span['rows'] = query_job.num_dml_affected_rows or 0
+        logging.info(f'INFO {query_job.num_dml_affected_rows} rows merged with sucess'  , extra={"json_fields": trace_id})
+
+    @classmethod
+    def proto_message(cls, fields: list) -> tuple:
+        """
+        Builds, once per schema, the protobuf message used to serialize the rows sent to the Storage Write API.
+        Args:
+            fields (list): The (column name, BigQuery type) pairs of the table.
+
+        Returns:
+            tuple: The DescriptorProto of the message and the message class.
+        """
+        key = tuple(fields)
+        with cls.proto_lock:
+            if key not in cls.proto_messages:
+                descriptor_pb2 = ClientRegistry.import_module('google.protobuf.descriptor_pb2')
+                descriptor_pool = ClientRegistry.import_module('google.protobuf.descriptor_pool')
+                message_factory = ClientRegistry.import_module('google.protobuf.message_factory')
+                descriptor = descriptor_pb2.DescriptorProto(name= 'Row')
+                for number, (name, type_) in enumerate(fields, start= 1):
+                    descriptor.field.add(
+                        name= name,
+                        number= number,
+                        type= getattr(descriptor_pb2.FieldDescriptorProto, cls.proto_types[type_]),
+                        label= descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+                    )
+                package = f"write_api_{len(cls.proto_messages)}"
+                file_descriptor = descriptor_pb2.FileDescriptorProto(name= f"{package}.proto", package= package, message_type= [descriptor])
+                pool = descriptor_pool.DescriptorPool()
+                pool.Add(file_descriptor)
+                message_class = message_factory.GetMessageClass(pool.FindMessageTypeByName(f"{package}.Row"))
+                cls.proto_messages[key] = (descriptor, message_class)
+            return cls.proto_messages[key]
+
+    def ensure_table(self, dataset_name: str, table_name: str, fields: list):
+        """
+        Create a table with the declared fields when it does not exist yet, once per process, as the Storage Write API
+        does not create tables like the load jobs do.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the table.
+            fields (list): The (column name, BigQuery type) pairs of the table.
+        """
+        table_id = f"{self.client.project}.{dataset_name}.{table_name}"
+        if table_id in self.write_api_tables:
+            return
+        bigquery = ClientRegistry.import_module('google.cloud.bigquery')
+        schema = [bigquery.SchemaField(name, type_) for name, type_ in fields]
+        self.client.create_table(bigquery.Table(table_id, schema= schema), exists_ok= True)
+        with self.write_api_lock:
+            self.write_api_tables.add(table_id)
+
+    def insert_arrow_write_api(self, dataset_name: str, table_name: str, arrow_tables: list, fields: list, stream_type: str = 'committed', batch_rows: int = 500, attempts: int = 3):
+        """
+        Append data from a list of pyarrow.Table to a BigQuery table with the Storage Write API, without load jobs.
+        The rows are sent in batches with explicit offsets, so a batch sent again after a failure is rejected by
+        BigQuery as already written, giving exactly once delivery. On a 'committed' stream the rows are visible as
+        soon as each batch is acknowledged, on a 'pending' stream they all become visible at once when the stream is committed.
+        Args:
+            dataset_name (str): The name of the dataset.
+            table_name (str): The name of the table.
+            arrow_tables (list): List of pyarrow.Table with the data to be appended.
+            fields (list): The (column name, BigQuery type) pairs of the table.
+            stream_type (str, optional): 'committed' or 'pending' (default is 'committed').
+            batch_rows (int, optional): Number of rows of each append request.
+            attempts (int, optional): Maximum number of times the append is tried, resuming from the last acknowledged offset.
+        """
+        if fields is None:
+            raise ValueError(f'The Storage Write API needs a declared schema for {dataset_name}.{table_name}')
+        types = ClientRegistry.import_module('google.cloud.bigquery_storage_v1').types
+        stream_types = {'committed' : types.WriteStream.Type.COMMITTED, 'pending' : types.WriteStream.Type.PENDING}
+        self.ensure_table(dataset_name, table_name, fields)
+        parent = f"projects/{self.client.project}/datasets/{dataset_name}/tables/{table_name}"
+        write_stream = self.write_client.create_write_stream(parent= parent, write_stream= types.WriteStream(type_= stream_types[stream_type]))
+        # The routing header tells the Storage Write API the region of the stream, the bidi append_rows call does not add it
+        metadata = (("x-goog-request-params", f"write_stream={write_stream.name}"),)
+        descriptor, message_class = self.proto_message(fields)
+        names = [name for name, _ in fields]
+        batch_sizes = {}
+
+        def append_requests(first_offset: int):
+            offset = 0
+            first_request = True
+            for arrow_table in arrow_tables:
+                for record_batch in arrow_table.to_batches(max_chunksize= batch_rows):
+                    if offset >= first_offset:
+                        proto_rows = types.ProtoRows()
+                        for row in record_batch.to_pylist():
+                            message = message_class(**{name : row[name] for name in names if row.get(name) is not None})
+                            proto_rows.serialized_rows.append(message.SerializeToString())
+                        proto_data = types.AppendRowsRequest.ProtoData(rows= proto_rows)
+                        request = types.AppendRowsRequest(offset= offset, proto_rows= proto_data)
+                        if first_request:
+                            request.write_stream = write_stream.name
+                            request.proto_rows.writer_schema = types.ProtoSchema(proto_descriptor= descriptor)
+                            first_request = False
+                        batch_sizes[offset] = record_batch.num_rows
+                        yield request
+                    offset += record_batch.num_rows
+
+        with Instrumentation.span('bigquery_load') as span:
+            acknowledged = 0
+            for attempt in range(1, attempts + 1):
+                try:
+                    for response in self.write_client.append_rows(requests= append_requests(acknowledged), metadata= metadata):
+                        if response.error.code not in (0, 6):
+                            raise RuntimeError(f'Append rows failed: {response.error.message}')
+                        if response.row_errors:
+                            raise RuntimeError(f'Append rows failed for {len(response.row_errors)} rows: {response.row_errors[0].message}')
+                        offset = response.append_result.offset or acknowledged
+                        acknowledged = max(acknowledged, offset + batch_sizes.get(offset, 0))
+                    break
+                except GoogleAPIError as error:
+                    if attempt == attempts:
+                        raise
+                    logging.warning(f'WARNING Append rows interrupted at offset {acknowledged}, retrying: {error}', extra={"json_fields": trace_id})
+                    span['retries'] += 1
+            self.write_client.finalize_write_stream(name= write_stream.name)
+            if stream_type == 'pending':
+                request = types.BatchCommitWriteStreamsRequest(parent= parent, write_streams= [write_stream.name])
+                response = self.write_client.batch_commit_write_streams(request= request)
+                if response.stream_errors:
+                    raise RuntimeError(f'Commit of the write stream failed: {response.stream_errors[0].error_message}')
+            span['rows'] = acknowledged
+        logging.info(f'INFO {acknowledged} rows streamed with sucess'  , extra={"json_fields": trace_id})
@@ -1,8 +1,44 @@
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import threading
 import logging
+from classes.instrumentation import Instrumentation
+from classes.rate_limiter import AdaptiveRateLimiter
+from classes.response_cache import ResponseCache
 from logger import trace_id
 
+class BoundedRetry(Retry):
+    '''
+    Retry whose waits are bounded, so a throttled request can not outlive the timeout of the function.
+    The exponential backoff is capped at max_backoff seconds, and a Retry-After header asking for more than
+    max_retry_after seconds ends the retries, returning the throttled response at once.
+
+    Parameters:
+        - max_backoff (float, optional): Maximum seconds waited by the exponential backoff between two retries.
+        - max_retry_after (float, optional): Maximum seconds of a Retry-After header that is still waited for.
+    '''
+    def __init__(self, *args, max_backoff: float = 10, max_retry_after: float = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+
+    def new(self, **kwargs) -> 'BoundedRetry':
+        return super().new(max_backoff= self.max_backoff, max_retry_after= self.max_retry_after, **kwargs)
+
+    def get_backoff_time(self) -> float:
+        return min(self.max_backoff, super().get_backoff_time())
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None) -> 'BoundedRetry':
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > self.max_retry_after:
+                raise MaxRetryError(_pool, url, ResponseError(f'Retry-After of {retry_after:.0f} seconds is over the limit of {self.max_retry_after:.0f} seconds'))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
 class BrasilApi:
     '''
     Class for interacting with the BrasilAPI (https://brasilapi.com.br/).
@@ -12,41 +48,185 @@ class BrasilApi:
         - query_parameter (str): Query parameter for the request in string format.
         - path_parameter (dict, optional): Path parameter for the request in a dictionary.
         - token (str, optional): An authentication token (if applicable) to access restricted resources.
+        - url (str, optional): Base url of the API, allowing to point the requests to another server.
+        - cache (ResponseCache, optional): Cache used to skip or revalidate the requests of unchanged resources.
+        - cache_scope (str, optional): Destination where the responses are saved, e.g. the bucket and folder, part of the cache key
+          so a response saved to one destination is not skipped when it is requested for another.
+
+    All the instances share a single keep-alive connection pool, configured with BrasilApi.configure_session,
+    and an adaptive rate limiter per host, created with the parameters in BrasilApi.rate_limiter_options.
     '''
-    def __init__(self, endpoint : str,  query_parameter : dict, path_parameter: str, token: str = None):
-        self.url = "https://brasilapi.com.br/api/"
+    session = None
+    session_lock = threading.Lock()
+    timeout = (5, 30)
+    rate_limiter_options = {}
+    throttle_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, endpoint : str,  query_parameter : dict, path_parameter: str, token: str = None, url: str = "https://brasilapi.com.br/api/", cache: ResponseCache = None, cache_scope: str = None):
+        self.url = url
+        self.cache = cache
+        self.cache_scope = cache_scope
         self.endpoint = endpoint 
         self.query_parameter = query_parameter
         self.path_parameter = path_parameter
         self.token = token
+
+    @staticmethod
+    def build_session(retries: int = 3, backoff_factor: float = 0.5, pool_maxsize: int = 10, max_backoff: float = 10, max_retry_after: float = 10) -> requests.Session:
+        '''
+        Builds a HTTP session with a keep-alive connection pool and retries with exponential backoff.
+
+        Parameters:
+            - retries (int, optional): Maximum number of retries for 429 and 5xx responses and connection errors.
+            - backoff_factor (float, optional): Factor of the exponential backoff between retries, the Retry-After header takes precedence when sent.
+            - pool_maxsize (int, optional): Maximum number of keep-alive connections kept per host.
+            - max_backoff (float, optional): Maximum seconds waited by the exponential backoff between two retries.
+            - max_retry_after (float, optional): A Retry-After header over this number of seconds fails the request instead of waiting.
+
+        Returns:
+            requests.Session: The session built.
+        '''
+        retry = BoundedRetry(
+            total= retries,
+            backoff_factor= backoff_factor,
+            max_backoff= max_backoff,
+            max_retry_after= max_retry_after,
+            status_forcelist= [429, 500, 502, 503, 504],
+            allowed_methods= ["GET"],
+            respect_retry_after_header= True,
+            raise_on_status= False
+        )
+        adapter = HTTPAdapter(pool_connections= pool_maxsize, pool_maxsize= pool_maxsize, max_retries= retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @classmethod
+    def configure_session(cls, retries: int = 3, backoff_factor: float = 0.5, pool_maxsize: int = 10, connect_timeout: float = 5, read_timeout: float = 30, max_backoff: float = 10, max_retry_after: float = 10) -> requests.Session:
+        '''
+        Replaces the HTTP session shared by all the instances.
+
+        Parameters:
+            - retries, backoff_factor, pool_maxsize, max_backoff, max_retry_after: Passed to BrasilApi.build_session.
+            - connect_timeout (float, optional): Timeout in seconds to establish a connection.
+            - read_timeout (float, optional): Timeout in seconds waiting for the server response.
+
+        Returns:
+            requests.Session: The shared session.
+        '''
+        session = cls.build_session(retries, backoff_factor, pool_maxsize, max_backoff, max_retry_after)
+        with cls.session_lock:
+            old_session = cls.session
+            cls.session = session
+            cls.timeout = (connect_timeout, read_timeout)
+        if old_session is not None:
+            old_session.close()
+        return session
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        '''
+        Returns the shared HTTP session, creating it with the default configuration on first use.
+        '''
+        if cls.session is None:
+            with cls.session_lock:
+                if cls.session is None:
+                    cls.session = cls.build_session()
+        return cls.session
     
-    def request_get(self) -> requests.Response:
+    def request_get(self, stream: bool = False) -> requests.Response:
         '''
-        Makes a request to the BrasilAPI with the specified parameters.
+        Makes a request to the BrasilAPI with the specified parameters, using the shared session.
+        Responses with status 429 and 5xx are retried with exponential backoff and slow down the rate limiter of the host.
+        With a cache, fresh entries are returned without a request and expired ones are revalidated with
+        If-None-Match/If-Modified-Since, the attribute not_modified of the response tells if the content is the cached one.
+
+        Parameters:
+            - stream (bool, optional): Do not read the body, so it can be consumed in chunks, the attribute streamed of the response is set.
 
         Returns:
             requests.Response: The response object of the request.
+
+        Raises:
+            requests.exceptions.RequestException: When the request fails after all the retries.
         '''
         if self.token is not None:
             header = {
                 "chave-api-dados" : self.token
             }
         else:
-            header = None
+            header = {}
 
         if self.path_parameter is None:
             complete_url = self.url + self.endpoint
         else:
             complete_url = self.url + self.endpoint + self.path_parameter
 
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(self.cache_key(complete_url))
+            if entry is not None:
+                try:
+                    if self.cache.is_fresh(entry):
+                        return self.cache.to_response(entry)
+                except OSError:
+                    entry = None
+            if entry is not None:
+                header.update(self.cache.conditional_headers(entry))
+
+        limiter = AdaptiveRateLimiter.for_host(urlsplit(complete_url).netloc, **self.rate_limiter_options)
+        limiter.acquire()
         try:
-            response = requests.get(url= complete_url, headers= header, params= self.query_parameter)
-            if response.status_code == 200:
-                return response
+            with Instrumentation.span('http_fetch') as span:
+                response = self.get_session().get(url= complete_url, headers= header, params= self.query_parameter, timeout= self.timeout, stream= stream)
+                span['retries'] = self.adapt_rate(limiter, response)
+                span['bytes'] = int(response.headers.get('Content-Length') or 0) if stream else len(response.content)
+            if entry is not None and response.status_code == 304:
+                self.cache.touch(entry['key'])
+                return self.cache.to_response(entry, revalidated= True)
             response.raise_for_status()
+            response.not_modified = False
+            response.streamed = stream
+            return response
         except requests.exceptions.RequestException as error:
             logging.error("ERROR There was an error in your solicitation" , extra={"json_fields": trace_id})
-            logging.error("ERROR" + error , extra={"json_fields": trace_id})
+            logging.error(f"ERROR {error}" , extra={"json_fields": trace_id})
+            raise
+
+    def adapt_rate(self, limiter: AdaptiveRateLimiter, response: requests.Response):
+        '''
+        Feeds the status of a response to the rate limiter, including the 429 and 5xx of the retries made by the session.
+
+        Returns:
+            int: The number of retries made by the session.
+        '''
+        retries = getattr(response.raw, 'retries', None)
+        history = getattr(retries, 'history', ())
+        for attempt in history:
+            if attempt.status in self.throttle_status:
+                limiter.on_throttle()
+        if response.status_code in self.throttle_status:
+            limiter.on_throttle()
+        else:
+            limiter.on_success()
+        return len(history)
+
+    def cache_key(self, complete_url: str = None) -> str:
+        '''
+        Generates the key of the request in the response cache, from the url, the file name of the parameters and the cache scope.
+        '''
+        if complete_url is None:
+            complete_url = self.url + self.endpoint + (self.path_parameter or '')
+        return f"{complete_url}|{self.generate_name_file()}|{self.cache_scope or ''}"
+
+    def commit_cache(self, response: requests.Response):
+        '''
+        Stores a response in the cache, it should be called only after the response was saved downstream,
+        so an unchanged resource is never skipped before being saved once.
+        '''
+        if self.cache is not None and not getattr(response, 'not_modified', False):
+            self.cache.put(self.cache_key(), response)
 
     def generate_name_file(self) -> str:
         '''
@@ -0,0 +1,104 @@
+import importlib
+import sys
+import threading
+import time
+
+class ClientRegistry:
+    '''
+    Registry of the Google Cloud clients and heavy modules, shared by all the invocations of a warm instance.
+    The clients are created on first use and reused afterwards, and the time spent importing modules and creating
+    clients is kept in a startup report, to follow the cold start latency.
+    '''
+    clients = {}
+    lock = threading.RLock()
+    imports_ms = {}
+    clients_ms = {}
+
+    @classmethod
+    def import_module(cls, module_name: str):
+        '''
+        Imports a module, recording the import time the first time it is loaded in the process.
+        The import always goes through importlib, which waits for a module still being initialized by another thread.
+
+        Returns:
+            module: The imported module.
+        '''
+        loaded = module_name in sys.modules
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        if not loaded:
+            cls.record_import(module_name, started)
+        return module
+
+    @classmethod
+    def record_import(cls, module_name: str, started: float):
+        '''
+        Records the time spent importing a module, started being the time.perf_counter() value before the import.
+        '''
+        with cls.lock:
+            cls.imports_ms.setdefault(module_name, round((time.perf_counter() - started) * 1000, 2))
+
+    @classmethod
+    def get_client(cls, name: str, factory):
+        '''
+        Returns a registered client, creating it with the factory on first use.
+
+        Parameters:
+            - name (str): The name of the client in the registry.
+            - factory (callable): Function without arguments that creates the client.
+        '''
+        client = cls.clients.get(name)
+        if client is not None:
+            return client
+        with cls.lock:
+            client = cls.clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                client = factory()
+                cls.clients_ms[name] = round((time.perf_counter() - started) * 1000, 2)
+                cls.clients[name] = client
+        return client
+
+    @classmethod
+    def register_client(cls, name: str, client):
+        '''
+        Registers a client created elsewhere, replacing the current one, e.g. to use a local stand-in.
+        '''
+        with cls.lock:
+            cls.clients[name] = client
+
+    @classmethod
+    def storage_client(cls):
+        '''
+        Returns the shared google.cloud.storage client.
+        '''
+        return cls.get_client('storage', lambda : cls.import_module('google.cloud.storage').Client())
+
+    @classmethod
+    def bigquery_client(cls):
+        '''
+        Returns the shared google.cloud.bigquery client.
+        '''
+        return cls.get_client('bigquery', lambda : cls.import_module('google.cloud.bigquery').Client())
+
+    @classmethod
+    def bigquery_write_client(cls):
+        '''
+        Returns the shared BigQuery Storage Write API client.
+        '''
+        return cls.get_client('bigquery_write', lambda : cls.import_module('google.cloud.bigquery_storage_v1').BigQueryWriteClient())
+
+    @classmethod
+    def logging_client(cls):
+        '''
+        Returns the shared google.cloud.logging client.
+        '''
+        return cls.get_client('logging', lambda : cls.import_module('google.cloud.logging').Client())
+
+    @classmethod
+    def report(cls) -> dict:
+        '''
+        Returns the startup report, with the import time of each module and the creation time of each client in milliseconds.
+        '''
+        with cls.lock:
+            return {'imports_ms' : dict(cls.imports_ms), 'clients_ms' : dict(cls.clients_ms)}
@@ -1,20 +1,91 @@
-from google.cloud import storage
+from __future__ import annotations
+from typing import TYPE_CHECKING
 from google.api_core.exceptions import GoogleAPIError
 import requests
-import pandas as pd
+import gzip
+import io
 import json
+import threading
+import time
 import logging
 from classes.all import decorator_try_except
+from classes.client_registry import ClientRegistry
+from classes.instrumentation import Instrumentation
+from classes.schemas import Schemas
+from classes.json_stream import EnvelopeStream, JsonStructureValidator
 from logger import trace_id
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from google.cloud import storage
+
 
 class CloudStorage:
     """
     A class for interacting with Google Cloud Storage, including operations such as creating buckets, uploading and downloading objects,
     handling JSON, and more.
+
+    Bucket handles are cached after the first lookup, so the operations do not repeat the bucket metadata request.
+    Args:
+        bucket_cache_ttl (float, optional): Seconds after which a cached bucket is validated again (default is None, never expires).
     """
-    def __init__(self):
-        self.storage_client = storage.Client()
+    def __init__(self, bucket_cache_ttl: float = None):
+        self.bucket_cache_ttl = bucket_cache_ttl
+        self.bucket_cache = {}
+        self.bucket_cache_lock = threading.Lock()
+        self.bucket_cache_stats = {'hits' : 0, 'misses' : 0}
+
+    @property
+    def storage_client(self) -> storage.Client:
+        """
+        The google.cloud.storage client shared by the process, created on first use.
+        """
+        return ClientRegistry.storage_client()
+
+    def get_bucket(self, bucket_name: str) -> storage.Bucket:
+        """
+        Returns the handle of a bucket, requesting its metadata only on the first use or when the cached handle expired.
+        Args:
+            bucket_name (str): The name of the bucket.
+
+        Returns:
+            storage.Bucket: The bucket handle.
+        """
+        with self.bucket_cache_lock:
+            cached = self.bucket_cache.get(bucket_name)
+            if cached is not None and (self.bucket_cache_ttl is None or time.monotonic() - cached[1] < self.bucket_cache_ttl):
+                self.bucket_cache_stats['hits'] += 1
+                return cached[0]
+        bucket = self.storage_client.get_bucket(bucket_name)
+        with self.bucket_cache_lock:
+            self.bucket_cache[bucket_name] = (bucket, time.monotonic())
+            self.bucket_cache_stats['misses'] += 1
+        return bucket
+
+    def invalidate_bucket_cache(self, bucket_name: str = None):
+        """
+        Removes a bucket from the cache, or all of them when no name is given.
+        Args:
+            bucket_name (str, optional): The name of the bucket.
+        """
+        with self.bucket_cache_lock:
+            if bucket_name is None:
+                self.bucket_cache.clear()
+            else:
+                self.bucket_cache.pop(bucket_name, None)
+
+    def bucket_cache_report(self) -> dict:
+        """
+        Returns the counters of the bucket cache.
+
+        Returns:
+            dict: Number of lookups served by the cache (round trips saved) and of metadata requests made.
+        """
+        with self.bucket_cache_lock:
+            return {
+                'bucket_round_trips_saved' : self.bucket_cache_stats['hits'],
+                'bucket_metadata_requests' : self.bucket_cache_stats['misses']
+            }
     
     @decorator_try_except
     def create_bucket(self, bucket_name: str, location : str ='us-central1'):
@@ -54,7 +125,7 @@ class CloudStorage:
         """
         if folder is not None:
             name_file = f"{folder}/{name_file}"
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
         blob.upload_from_filename(source_file_name)
         logging.info('Object Uploaded with Sucess' , extra={"json_fields": trace_id})
@@ -68,55 +139,404 @@ class CloudStorage:
             object_request (requests.Response): The response from the request containing the JSON.
             name_file (str): The name of the file in the bucket.
             folder (str, optional): The folder in the bucket where the file will be stored.
+
+        Returns:
+            str: The name of the uploaded blob.
         """
         if folder is not None:
             name_file = f"{folder}/{name_file}"
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
         json_string = json.dumps(object_request.json())
         json_bytes = json_string.encode('utf-8')
-        blob.upload_from_string(json_bytes, content_type='application/json') 
+        with Instrumentation.span('gcs_upload') as span:
+            blob.upload_from_string(json_bytes, content_type='application/json') 
+            span['bytes'] = len(json_bytes)
         logging.info('INFO Request Object uploaded with sucess' , extra={"json_fields": trace_id})
+        return blob.name
 
     @decorator_try_except
-    def request_to_json_envelope_file(self, bucket_name, object_request: requests.Response, name_file: str, envelope: dict, folder = None):
+    def request_to_json_envelope_file(self, bucket_name, object_request: requests.Response, name_file: str, envelope: dict, folder = None, validate: bool = False, chunk_size: int = 1024 * 1024, multipart_max_bytes: int = 8 * 1024 * 1024):
         """
         Uploads a JSON object with an envelope from a request response into a file in the bucket.
+        The raw bytes of the body are streamed into the file between the envelope prefix and suffix, without parsing
+        the JSON, and the envelope is also saved as metadata of the object. Bodies larger than multipart_max_bytes are
+        sent with a resumable upload in chunks, a body of unknown size (e.g. with a Content-Encoding) is read up to
+        multipart_max_bytes first and sent with a single request when it fits.
         Args:
             bucket_name (str): The name of the target bucket.
             object_request (requests.Response): The response from the request containing the JSON.
             name_file (str): The name of the file in the bucket.
             envelope: The envelope to be included in the JSON file.
             folder (str, optional): The folder in the bucket where the file will be stored.
+            validate (bool, optional): Checks the structure of the JSON incrementally while uploading, aborting the upload when invalid.
+            chunk_size (int, optional): Size of the chunks of resumable uploads, a multiple of 256 KB.
+            multipart_max_bytes (int, optional): Maximum size of the file sent with a single request.
+
+        Returns:
+            dict: The name, size, generation and md5_hash of the uploaded blob, as listed by list_objects_pages.
         """
         if folder is not None:
             name_file = f"{folder}/{name_file}"
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(name_file)
+        blob.metadata = {key : str(value) for key, value in envelope['envelope'].items()}
+        prefix = ('{"envelope": ' + json.dumps(envelope['envelope']) + ', "content": ').encode('utf-8')
+        suffix = b'}'
+        if getattr(object_request, 'streamed', False):
+            content_length = object_request.headers.get('Content-Length')
+            size = None
+            if content_length is not None and 'Content-Encoding' not in object_request.headers:
+                size = len(prefix) + int(content_length) + len(suffix)
+        else:
+            size = len(prefix) + len(object_request.content) + len(suffix)
+        validator = JsonStructureValidator() if validate else None
+        stream = EnvelopeStream(prefix, object_request.iter_content(chunk_size= 64 * 1024), suffix, validator)
+        try:
+            with Instrumentation.span('gcs_upload') as span:
+                if size is None:
+                    head = stream.read(multipart_max_bytes + 1)
+                    if len(head) <= multipart_max_bytes:
+                        size = len(head)
+                    stream.seek(0)
+                if size is None or size > multipart_max_bytes:
+                    size = None
+                    blob.chunk_size = chunk_size
+                blob.upload_from_file(stream, size= size, content_type='application/json')
+                span['bytes'] = stream.tell()
+        finally:
+            object_request.close()
+        logging.info('INFO Request Object with envelope uploaded with sucess' , extra={"json_fields": trace_id})
+        return self.blob_item(blob)
+
+    @decorator_try_except
+    def json_envelope_to_file(self, bucket_name: str, json_content: dict, name_file: str, folder: str = None):
+        """
+        Uploads an already parsed JSON object with an envelope into a file in the bucket.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            json_content (dict): Dictionary with the 'envelope' and 'content' keys.
+            name_file (str): The name of the file in the bucket.
+            folder (str, optional): The folder in the bucket where the file will be stored.
+
+        Returns:
+            dict: The name, size, generation and md5_hash of the uploaded blob, as listed by list_objects_pages.
+        """
+        if folder is not None:
+            name_file = f"{folder}/{name_file}"
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
-        json_content = {}
-        json_content['envelope'] = envelope['envelope']
-        json_content['content'] = object_request.json()
         json_string = json.dumps(json_content)
         json_bytes = json_string.encode('utf-8')
-        blob.upload_from_string(json_bytes, content_type='application/json') 
+        with Instrumentation.span('gcs_upload') as span:
+            blob.upload_from_string(json_bytes, content_type='application/json') 
+            span['bytes'] = len(json_bytes)
+            span['rows'] = len(json_content['content'])
         logging.info('INFO Request Object with envelope uploaded with sucess' , extra={"json_fields": trace_id})
+        return self.blob_item(blob)
+
+    @staticmethod
+    def landing_name_file(name_file: str, landing_format: str) -> str:
+        """
+        Returns the name of a file with the extension of a landing format.
+        Args:
+            name_file (str): The name of the file, usually ending with .json.
+            landing_format (str): One of 'json', 'ndjson.gz', 'ndjson.zst' or 'parquet'.
+        """
+        if name_file.endswith('.json'):
+            name_file = name_file[:-len('.json')]
+        return f"{name_file}.{landing_format}"
 
+    @staticmethod
+    def envelope_to_rows(json_content: dict) -> list:
+        """
+        Returns the rows of the content of a JSON object with an envelope, with the envelope fields inlined in each row.
+        """
+        return [{**row, **json_content['envelope']} for row in json_content['content']]
 
     @decorator_try_except
-    def list_objects_buckets(self, bucket_name: str, folder = None) -> str:
+    def json_envelope_to_landing_file(self, bucket_name: str, json_content: dict, name_file: str, folder: str = None, landing_format: str = 'json', table_id: str = 'brasil_api.municipios'):
+        """
+        Uploads an already parsed JSON object with an envelope into a file in the bucket, in one of the landing formats:
+        'json' (the envelope and the content in a single object), 'ndjson.gz' and 'ndjson.zst' (compressed newline
+        delimited JSON with the envelope fields inlined in each row) or 'parquet' (with the declared schema of the table).
+        The 'ndjson.zst' format requires the zstandard package, and can not be loaded by big query directly from Cloud Storage.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            json_content (dict): Dictionary with the 'envelope' and 'content' keys.
+            name_file (str): The name of the file in the bucket, the extension is replaced by the one of the format.
+            folder (str, optional): The folder in the bucket where the file will be stored.
+            landing_format (str, optional): The format of the file (default is 'json').
+            table_id (str, optional): The table whose declared schema is used by the parquet format.
+
+        Returns:
+            dict: The name, size, generation and md5_hash of the uploaded blob, as listed by list_objects_pages.
+        """
+        if landing_format == 'json':
+            return self.json_envelope_to_file(bucket_name, json_content, name_file, folder)
+        name_file = self.landing_name_file(name_file, landing_format)
+        if folder is not None:
+            name_file = f"{folder}/{name_file}"
+        if landing_format in ('ndjson.gz', 'ndjson.zst'):
+            rows = self.envelope_to_rows(json_content)
+            ndjson_bytes = "".join(json.dumps(row) + "\n" for row in rows).encode('utf-8')
+            if landing_format == 'ndjson.gz':
+                file_bytes = gzip.compress(ndjson_bytes)
+            else:
+                file_bytes = ClientRegistry.import_module('zstandard').ZstdCompressor().compress(ndjson_bytes)
+            content_type = 'application/x-ndjson'
+        elif landing_format == 'parquet':
+            pq = ClientRegistry.import_module('pyarrow.parquet')
+            table = self.envelope_to_arrow_table(json_content, table_id)
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer, compression= 'zstd')
+            file_bytes = buffer.getvalue()
+            content_type = 'application/vnd.apache.parquet'
+        else:
+            raise ValueError(f'Unknown landing format {landing_format}')
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(name_file)
+        with Instrumentation.span('gcs_upload') as span:
+            blob.upload_from_string(file_bytes, content_type= content_type)
+            span['bytes'] = len(file_bytes)
+            span['rows'] = len(json_content['content'])
+        logging.info(f'INFO Request Object uploaded with sucess as {landing_format}' , extra={"json_fields": trace_id})
+        return self.blob_item(blob)
+
+    @decorator_try_except
+    def landing_file_to_dataframe(self, bucket_name: str, name_file: str, folder: str = None) -> pd.DataFrame:
+        """
+        Converts a file in any of the landing formats, chosen by its extension, to a Pandas DataFrame with the envelope fields as columns.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            name_file (str): The name of the file in the bucket.
+            folder (str, optional): The folder in the bucket where the file is stored.
+        """
+        if name_file.endswith('.json'):
+            return self.json_envelope_to_dataframe(bucket_name, name_file, folder)
+        if folder is not None:
+            name_file = f"{folder}/{name_file}"
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(name_file)
+        file_bytes = self.download_bytes(blob)
+        pd = ClientRegistry.import_module('pandas')
+        with Instrumentation.span('table_build') as span:
+            if name_file.endswith('.parquet'):
+                data_frame = pd.read_parquet(io.BytesIO(file_bytes))
+            else:
+                if name_file.endswith('.ndjson.gz'):
+                    ndjson_bytes = gzip.decompress(file_bytes)
+                elif name_file.endswith('.ndjson.zst'):
+                    ndjson_bytes = ClientRegistry.import_module('zstandard').ZstdDecompressor().decompress(file_bytes)
+                else:
+                    raise ValueError(f'Unknown landing format of {name_file}')
+                data_frame = pd.DataFrame([json.loads(line) for line in ndjson_bytes.splitlines() if line])
+            span['rows'] = len(data_frame)
+        return data_frame
+
+    @staticmethod
+    def conform_arrow_table(table, schema):
+        """
+        Conforms a pyarrow.Table to a schema, adding the missing columns as nulls, ordering the columns and casting them.
+        Without a schema the table is returned unchanged.
+        """
+        if schema is None:
+            return table
+        pa = ClientRegistry.import_module('pyarrow')
+        for field in schema:
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+        return table.select(schema.names).cast(schema)
+
+    @classmethod
+    def envelope_to_arrow_table(cls, json_dict: dict, table_id: str = 'brasil_api.municipios'):
+        """
+        Converts an already parsed JSON object with an envelope to a pyarrow.Table, without a Pandas DataFrame.
+        The envelope fields are added as dictionary encoded constant columns and the table follows the declared schema
+        of the table, when there is one.
+        Args:
+            json_dict (dict): Dictionary with the 'envelope' and 'content' keys.
+            table_id (str, optional): The table, in the format dataset.table, whose declared schema is used.
+
+        Returns:
+            pyarrow.Table: The content with the envelope columns.
+        """
+        pa = ClientRegistry.import_module('pyarrow')
+        schema = Schemas.arrow_schema(table_id)
+        envelope = json_dict['envelope']
+        content_schema = None
+        if schema is not None:
+            content_schema = pa.schema([field for field in schema if field.name not in envelope])
+        with Instrumentation.span('table_build') as span:
+            table = pa.Table.from_pylist(json_dict['content'], schema= content_schema)
+            indices = pa.array([0] * table.num_rows, type= pa.int32())
+            for key, value in envelope.items():
+                dictionary = pa.array([value])
+                if schema is not None and key in schema.names:
+                    dictionary = dictionary.cast(schema.field(key).type.value_type)
+                column = pa.DictionaryArray.from_arrays(indices, dictionary)
+                table = table.append_column(pa.field(key, column.type), column)
+            table = cls.conform_arrow_table(table, schema)
+            span['rows'] = table.num_rows
+        return table
+
+    @decorator_try_except
+    def landing_file_to_arrow_table(self, bucket_name: str, name_file: str, folder: str = None, table_id: str = 'brasil_api.municipios'):
+        """
+        Converts a file in any of the landing formats, chosen by its extension, to a pyarrow.Table with the envelope fields as columns.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            name_file (str): The name of the file in the bucket.
+            folder (str, optional): The folder in the bucket where the file is stored.
+            table_id (str, optional): The table, in the format dataset.table, whose declared schema is used.
+        """
+        if folder is not None:
+            name_file = f"{folder}/{name_file}"
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(name_file)
+        file_bytes = self.download_bytes(blob)
+        return self.landing_bytes_to_arrow_table(name_file, file_bytes, table_id)
+
+    @classmethod
+    def landing_bytes_to_arrow_table(cls, name_file: str, file_bytes: bytes, table_id: str = 'brasil_api.municipios'):
+        """
+        Converts the content of a file in any of the landing formats, chosen by its extension, to a pyarrow.Table.
+        It does not use the client, so it can run in another process.
+        Args:
+            name_file (str): The name of the file, only its extension is used.
+            file_bytes (bytes): The content of the file.
+            table_id (str, optional): The table, in the format dataset.table, whose declared schema is used.
+        """
+        if name_file.endswith('.json'):
+            return cls.envelope_to_arrow_table(json.loads(file_bytes), table_id)
+        with Instrumentation.span('table_build') as span:
+            if name_file.endswith('.parquet'):
+                table = ClientRegistry.import_module('pyarrow.parquet').read_table(io.BytesIO(file_bytes))
+            else:
+                if name_file.endswith('.ndjson.gz'):
+                    ndjson_bytes = gzip.decompress(file_bytes)
+                elif name_file.endswith('.ndjson.zst'):
+                    ndjson_bytes = ClientRegistry.import_module('zstandard').ZstdDecompressor().decompress(file_bytes)
+                else:
+                    raise ValueError(f'Unknown landing format of {name_file}')
+                table = ClientRegistry.import_module('pyarrow.json').read_json(io.BytesIO(ndjson_bytes))
+            table = cls.conform_arrow_table(table, Schemas.arrow_schema(table_id))
+            span['rows'] = table.num_rows
+        return table
+
+    @staticmethod
+    def download_bytes(blob: storage.Blob) -> bytes:
+        """
+        Downloads the content of a blob, timed as a span of the gcs_download stage.
+        """
+        with Instrumentation.span('gcs_download') as span:
+            file_bytes = blob.download_as_bytes()
+            span['bytes'] = len(file_bytes)
+        return file_bytes
+
+    @decorator_try_except
+    def download_file_bytes(self, bucket_name: str, name_file: str) -> bytes:
+        """
+        Downloads the content of a file in the bucket.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            name_file (str): The name of the file in the bucket.
+
+        Returns:
+            bytes: The content of the file.
+        """
+        bucket = self.get_bucket(bucket_name)
+        return self.download_bytes(bucket.blob(name_file))
+
+    @decorator_try_except
+    def read_json_file(self, bucket_name: str, name_file: str) -> tuple:
+        """
+        Reads a JSON file from the bucket together with its generation.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            name_file (str): The name of the JSON file in the bucket.
+
+        Returns:
+            tuple: The parsed JSON and the generation of the file, or an empty dictionary and 0 when the file does not exist.
+        """
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.get_blob(name_file)
+        if blob is None:
+            return {}, 0
+        json_dict = json.loads(blob.download_as_text(if_generation_match= blob.generation))
+        return json_dict, blob.generation
+
+    @decorator_try_except
+    def write_json_file(self, bucket_name: str, json_content: dict, name_file: str, if_generation_match: int = None) -> int:
+        """
+        Writes a dictionary as a JSON file in the bucket.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            json_content (dict): The content of the file.
+            name_file (str): The name of the file in the bucket.
+            if_generation_match (int, optional): Only writes if the current generation of the file matches, 0 meaning the file must not exist.
+
+        Returns:
+            int: The generation of the written file.
+        """
+        bucket = self.get_bucket(bucket_name)
+        blob = bucket.blob(name_file)
+        json_bytes = json.dumps(json_content).encode('utf-8')
+        blob.upload_from_string(json_bytes, content_type='application/json', if_generation_match= if_generation_match)
+        return blob.generation
+
+    @decorator_try_except
+    def list_objects_buckets(self, bucket_name: str, folder = None) -> list:
         """
         Lists all objects in a specified bucket.
         Args:
             bucket_name (str): The name of the target bucket.
+            folder (str, optional): Only the objects inside this folder are listed.
+
+        Returns:
+            List[str]: A list of object names.
         """
-        bucket = self.storage_client.get_bucket(bucket_name)
-        blobs = bucket.list_blobs()
         list_files = []
-        for item in blobs:
-            list_files.append(item.name)
-        if folder is not None:
-            list_files = list(filter(lambda item : folder in item, list_files))
+        for page in self.list_objects_pages(bucket_name, folder):
+            for item in page:
+                list_files.append(item['name'])
         return list_files
+
+    @staticmethod
+    def blob_item(blob: storage.Blob) -> dict:
+        """
+        Returns the metadata of a blob used to identify the version of a file, as in the pages of list_objects_pages.
+        """
+        return {
+            'name' : blob.name,
+            'size' : blob.size,
+            'generation' : blob.generation,
+            'md5_hash' : blob.md5_hash,
+            'updated' : blob.updated,
+            'content_type' : blob.content_type
+        }
+
+    def list_objects_pages(self, bucket_name: str, folder: str = None, delimiter: str = None, match_glob: str = None, page_size: int = None):
+        """
+        Lazily lists the objects of a bucket page by page, filtering them on the server side.
+        Args:
+            bucket_name (str): The name of the target bucket.
+            folder (str, optional): Only the objects inside this folder are listed.
+            delimiter (str, optional): Delimiter to list only the direct children of the folder, usually '/'.
+            match_glob (str, optional): Glob pattern the object names must match, e.g. '**.json'.
+            page_size (int, optional): Maximum number of objects in each page.
+
+        Yields:
+            List[dict]: The objects of a page, with name, size, generation, md5_hash, updated and content_type.
+        """
+        prefix = f"{folder.rstrip('/')}/" if folder is not None else None
+        bucket = self.get_bucket(bucket_name)
+        blobs = bucket.list_blobs(prefix= prefix, delimiter= delimiter, match_glob= match_glob, page_size= page_size)
+        for page in blobs.pages:
+            list_page = []
+            for item in page:
+                list_page.append(self.blob_item(item))
+            yield list_page
     
     @decorator_try_except
     def delete_file(self, bucket_name: str, name_file: str):
@@ -126,7 +546,7 @@ class CloudStorage:
             bucket_name (str): The name of the target bucket.
             name_file (str): The name of the file to be deleted.
         """
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
         blob.delete()
         logging.info("INFO File {} deleted.".format(blob.name) , extra={"json_fields": trace_id})
@@ -139,8 +559,9 @@ class CloudStorage:
         Args:
             bucket_name (str): The name of the bucket to be deleted.
         """
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         bucket.delete()
+        self.invalidate_bucket_cache(bucket_name)
         logging.info("INFO Bucket {} deleted.".format(bucket.name) , extra={"json_fields": trace_id})
 
 
@@ -153,7 +574,7 @@ class CloudStorage:
             file_name (str): The name of the object in the bucket.
             output_file_name (str): The name of the local output file.
         """
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.get_blob(file_name)
         blob.download_to_filename(output_file_name)
 
@@ -171,10 +592,13 @@ class CloudStorage:
         """
         if folder is not None:
                 name_file = f"{folder}/{name_file}"
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
-        json_string = blob.download_as_text()
-        data_frame = pd.read_json(json_string)
+        json_string = self.download_bytes(blob).decode('utf-8')
+        pd = ClientRegistry.import_module('pandas')
+        with Instrumentation.span('table_build') as span:
+            data_frame = pd.read_json(json_string)
+            span['rows'] = len(data_frame)
         return data_frame
     
     @decorator_try_except
@@ -188,10 +612,22 @@ class CloudStorage:
         """
         if folder is not None:
                 name_file = f"{folder}/{name_file}"
-        bucket = self.storage_client.get_bucket(bucket_name)
+        bucket = self.get_bucket(bucket_name)
         blob = bucket.blob(name_file)
-        json_dict = json.loads(blob.download_as_text())
-        data_frame = pd.DataFrame(json_dict['content'])
-        for key, value in json_dict['envelope'].items():
-            data_frame[key] = value 
+        json_dict = json.loads(self.download_bytes(blob))
+        return self.envelope_to_dataframe(json_dict)
+
+    @staticmethod
+    def envelope_to_dataframe(json_dict: dict) -> pd.DataFrame:
+        """
+        Converts an already parsed JSON object with an envelope to a Pandas DataFrame, with the envelope keys as columns.
+        Args:
+            json_dict (dict): Dictionary with the 'envelope' and 'content' keys.
+        """
+        pd = ClientRegistry.import_module('pandas')
+        with Instrumentation.span('table_build') as span:
+            data_frame = pd.DataFrame(json_dict['content'])
+            for key, value in json_dict['envelope'].items():
+                data_frame[key] = value 
+            span['rows'] = len(data_frame)
         return data_frame
\ No newline at end of file
@@ -0,0 +1,85 @@
+import logging
+from classes.cloud_storage import CloudStorage
+from logger import trace_id
+
+class IngestionManifest:
+    """
+    A manifest of the files already loaded into big query, persisted as a JSON file in Cloud Storage.
+    The files are identified by their name and generation (or md5 when the generation is missing), so a rerun
+    only processes the objects that are new or were changed since the last load.
+    Args:
+        storage_object (CloudStorage): The object used to read and write the manifest.
+        bucket_name (str): The name of the bucket where the manifest is stored.
+        name_file (str): The name of the manifest file in the bucket.
+    The manifests are kept under IngestionManifest.prefix, the listings of landing files leave this prefix out.
+    """
+    prefix = '_manifest/'
+
+    def __init__(self, storage_object: CloudStorage, bucket_name: str, name_file: str):
+        self.storage_object = storage_object
+        self.bucket_name = bucket_name
+        self.name_file = name_file
+        self.entries = {}
+        self.pending = {}
+        self.generation = 0
+
+    def load(self):
+        """
+        Reads the manifest from Cloud Storage, starting an empty one when the file does not exist yet.
+        """
+        result = self.storage_object.read_json_file(self.bucket_name, self.name_file)
+        if result is None:
+            raise RuntimeError(f'Manifest {self.name_file} could not be read')
+        self.entries, self.generation = result
+        self.entries.update(self.pending)
+        logging.info(f'INFO Manifest {self.name_file} loaded with {len(self.entries)} files', extra={"json_fields": trace_id})
+
+    @staticmethod
+    def file_version(item: dict) -> str:
+        """
+        Returns the version of a file, from the metadata returned by CloudStorage.list_objects_pages.
+        """
+        return str(item.get('generation') or item.get('md5_hash'))
+
+    def is_loaded(self, item: dict) -> bool:
+        """
+        Checks if the same version of a file was already loaded.
+        Args:
+            item (dict): The file metadata returned by CloudStorage.list_objects_pages.
+        """
+        return self.entries.get(item['name']) == self.file_version(item)
+
+    def has_file(self, name_file: str) -> bool:
+        """
+        Checks if any version of a file was already loaded.
+        Args:
+            name_file (str): The name of the file in the bucket.
+        """
+        return name_file in self.entries
+
+    def mark_loaded(self, items: list):
+        """
+        Registers files as loaded, they are persisted on the next save.
+        Args:
+            items (list): The metadata of the files returned by CloudStorage.list_objects_pages.
+        """
+        for item in items:
+            version = self.file_version(item)
+            self.entries[item['name']] = version
+            self.pending[item['name']] = version
+
+    def save(self, attempts: int = 3):
+        """
+        Writes the manifest to Cloud Storage only if it was not changed by another execution since it was read,
+        otherwise the manifest is read again, merged with the files registered here and written again.
+        Args:
+            attempts (int, optional): Maximum number of times the write is tried.
+        """
+        for _ in range(attempts):
+            generation = self.storage_object.write_json_file(self.bucket_name, self.entries, self.name_file, self.generation)
+            if generation is not None:
+                self.generation = generation
+                self.pending = {}
+                return
+            self.load()
+        raise RuntimeError(f'Manifest {self.name_file} could not be saved')
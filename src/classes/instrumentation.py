@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+import random
+import threading
+import time
+
+class Instrumentation:
+    '''
+    Collects the latency and the throughput of the stages of an execution (HTTP fetch, Cloud Storage upload and download,
+    table build, BigQuery load), shared by all the threads of the process.
+    Each span costs two perf_counter calls and a lock, the durations are kept in a bounded random sample per stage,
+    so it can stay on in production. Instrumentation.summary gives the p50/p95 of each stage, to be logged as JSON fields.
+    '''
+    stages = {}
+    lock = threading.Lock()
+    max_samples = 2048
+
+    @classmethod
+    @contextmanager
+    def span(cls, stage: str):
+        '''
+        Times the block of a with statement as a span of a stage, the yielded dictionary receives the bytes, rows and
+        retries of the span. A span whose block raises an exception is counted as an error and the exception is propagated.
+
+        Parameters:
+            - stage (str): The name of the stage, e.g. 'http_fetch'.
+        '''
+        metrics = {'bytes' : 0, 'rows' : 0, 'retries' : 0}
+        error = False
+        started = time.perf_counter()
+        try:
+            yield metrics
+        except BaseException:
+            error = True
+            raise
+        finally:
+            cls.record(stage, time.perf_counter() - started, error= error, **metrics)
+
+    @classmethod
+    def record(cls, stage: str, seconds: float, bytes: int = 0, rows: int = 0, retries: int = 0, error: bool = False):
+        '''
+        Records a span of a stage measured by the caller.
+        '''
+        with cls.lock:
+            metrics = cls.stages.get(stage)
+            if metrics is None:
+                metrics = cls.stages[stage] = {'count' : 0, 'errors' : 0, 'seconds' : 0.0, 'bytes' : 0, 'rows' : 0, 'retries' : 0, 'max' : 0.0, 'samples' : []}
+            metrics['count'] += 1
+            metrics['errors'] += int(error)
+            metrics['seconds'] += seconds
+            metrics['max'] = max(metrics['max'], seconds)
+            metrics['bytes'] += bytes or 0
+            metrics['rows'] += rows or 0
+            metrics['retries'] += retries or 0
+            if len(metrics['samples']) < cls.max_samples:
+                metrics['samples'].append(seconds)
+            else:
+                index = random.randrange(metrics['count'])
+                if index < cls.max_samples:
+                    metrics['samples'][index] = seconds
+
+    @classmethod
+    def reset(cls):
+        '''
+        Removes the spans recorded, e.g. at the start of an execution.
+        '''
+        with cls.lock:
+            cls.stages = {}
+
+    @staticmethod
+    def percentile(samples: list, percent: float) -> float:
+        '''
+        Returns the nearest rank percentile of sorted samples.
+        '''
+        if not samples:
+            return 0.0
+        index = max(0, min(len(samples) - 1, round(percent / 100 * len(samples) + 0.5) - 1))
+        return samples[index]
+
+    @classmethod
+    def summary(cls) -> dict:
+        '''
+        Returns, for each stage, the number of spans and errors, the p50/p95/max latency in milliseconds, the bytes, rows
+        and retries, and the throughput in MB per second of span time (spans running in parallel add up their time).
+        '''
+        with cls.lock:
+            stages = {stage : dict(metrics, samples= sorted(metrics['samples'])) for stage, metrics in cls.stages.items()}
+        summary = {}
+        for stage, metrics in stages.items():
+            samples = metrics['samples']
+            summary[stage] = {
+                'count' : metrics['count'],
+                'errors' : metrics['errors'],
+                'p50_ms' : round(cls.percentile(samples, 50) * 1000, 2),
+                'p95_ms' : round(cls.percentile(samples, 95) * 1000, 2),
+                'max_ms' : round(metrics['max'] * 1000, 2),
+                'total_seconds' : round(metrics['seconds'], 3),
+                'bytes' : metrics['bytes'],
+                'rows' : metrics['rows'],
+                'retries' : metrics['retries'],
+                'mb_per_second' : round(metrics['bytes'] / 1024 / 1024 / metrics['seconds'], 3) if metrics['seconds'] else 0.0
+            }
+        return summary
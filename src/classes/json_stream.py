@@ -0,0 +1,151 @@
+import io
+
+class JsonStructureValidator:
+    '''
+    Incremental validator of the structure of a JSON document, fed chunk by chunk without parsing the values.
+    It checks that the document is a single array or object with balanced brackets and closed strings.
+    '''
+    closing = {ord('[') : ord(']'), ord('{') : ord('}')}
+    whitespace = b' \t\r\n'
+
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk: bytes):
+        '''
+        Validates the next chunk of the document.
+
+        Raises:
+            ValueError: When the chunk breaks the structure of the document.
+        '''
+        for byte in chunk:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif byte == 0x5c:
+                    self.escaped = True
+                elif byte == 0x22:
+                    self.in_string = False
+                continue
+            if byte in self.whitespace:
+                continue
+            if self.finished:
+                raise ValueError('Unexpected data after the end of the JSON document')
+            if not self.started:
+                if byte not in self.closing:
+                    raise ValueError('The JSON document is not an array or an object')
+                self.started = True
+            if byte == 0x22:
+                self.in_string = True
+            elif byte in self.closing:
+                self.stack.append(self.closing[byte])
+            elif byte in (0x5d, 0x7d):
+                if not self.stack or self.stack.pop() != byte:
+                    raise ValueError('Unbalanced brackets in the JSON document')
+                if not self.stack:
+                    self.finished = True
+
+    def close(self):
+        '''
+        Checks that the document fed is complete.
+
+        Raises:
+            ValueError: When the document is incomplete.
+        '''
+        if not self.finished:
+            raise ValueError('Incomplete JSON document')
+
+
+class EnvelopeStream(io.RawIOBase):
+    '''
+    Read-only file object that writes a prefix, the chunks of a raw JSON body and a suffix, so the body is
+    enveloped while it is uploaded, without parsing it or keeping a full copy in memory.
+    Only the last block read is kept, allowing a resumable upload to seek back into it to send it again.
+
+    Parameters:
+        - prefix (bytes): Bytes written before the body.
+        - chunks (iterator): Iterator of the chunks of the body.
+        - suffix (bytes): Bytes written after the body.
+        - validator (JsonStructureValidator, optional): Validator fed with the chunks of the body.
+    '''
+    def __init__(self, prefix: bytes, chunks, suffix: bytes, validator: JsonStructureValidator = None):
+        self.parts = iter([prefix])
+        self.chunks = chunks
+        self.suffix = suffix
+        self.validator = validator
+        self.buffer = b''
+        self.last_read = b''
+        self.position = 0
+        self.body_finished = False
+        self.bytes_body = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('EnvelopeStream only seeks from the start or the current position')
+        back = self.position - offset
+        if back < 0 or back > len(self.last_read):
+            raise io.UnsupportedOperation('EnvelopeStream only seeks back into the last block read')
+        if back > 0:
+            self.buffer = self.last_read[len(self.last_read) - back:] + self.buffer
+            self.last_read = self.last_read[:len(self.last_read) - back]
+            self.position = offset
+        return self.position
+
+    def next_part(self) -> bytes:
+        '''
+        Returns the next non empty part of the stream, or an empty bytes at the end.
+        '''
+        for part in self.parts:
+            if part:
+                return part
+        if not self.body_finished:
+            for chunk in self.chunks:
+                if chunk:
+                    self.bytes_body += len(chunk)
+                    if self.validator is not None:
+                        self.validator.feed(chunk)
+                    return chunk
+            self.body_finished = True
+            if self.validator is not None:
+                self.validator.close()
+            self.parts = iter([self.suffix])
+            return self.next_part()
+        return b''
+
+    def read(self, size: int = -1) -> bytes:
+        ls_parts = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            part = self.next_part()
+            if not part:
+                break
+            ls_parts.append(part)
+            length += len(part)
+        data = b''.join(ls_parts)
+        if size >= 0:
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = b''
+        self.last_read = data
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
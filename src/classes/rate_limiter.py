@@ -0,0 +1,117 @@
+import threading
+import time
+
+class AdaptiveRateLimiter:
+    '''
+    Token bucket limiter of the requests per second sent to a host, shared by all the threads of the process.
+    The rate adapts with AIMD: it grows additively on each successful response and is cut multiplicatively on
+    throttling (429) and server errors (5xx), at most once per cooldown, so a burst of errors counts as one signal.
+
+    Parameters:
+        - rate (float, optional): Initial requests per second.
+        - min_rate (float, optional): Lowest requests per second the rate is cut to.
+        - max_rate (float, optional): Highest requests per second the rate grows to.
+        - increase (float, optional): Requests per second added to the rate on each success.
+        - decrease_factor (float, optional): Factor applied to the rate on throttling.
+        - cooldown (float, optional): Minimum seconds between two cuts of the rate.
+    '''
+    limiters = {}
+    limiters_lock = threading.Lock()
+
+    def __init__(self, rate: float = 10, min_rate: float = 0.5, max_rate: float = 50, increase: float = 0.2, decrease_factor: float = 0.5, cooldown: float = 1):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.decreased_at = 0.0
+        self.lock = threading.Lock()
+        self.counters = {'acquired' : 0, 'throttled' : 0, 'decreases' : 0, 'waited_seconds' : 0.0}
+
+    @classmethod
+    def for_host(cls, host: str, **kwargs) -> 'AdaptiveRateLimiter':
+        '''
+        Returns the limiter of a host, creating it with the given parameters on first use.
+        '''
+        with cls.limiters_lock:
+            if host not in cls.limiters:
+                cls.limiters[host] = cls(**kwargs)
+            return cls.limiters[host]
+
+    @classmethod
+    def report_all(cls) -> dict:
+        '''
+        Returns the report of the limiter of each host.
+        '''
+        with cls.limiters_lock:
+            limiters = dict(cls.limiters)
+        return {host : limiter.report() for host, limiter in limiters.items()}
+
+    @classmethod
+    def reset_all(cls):
+        '''
+        Resets the counters of all the limiters, keeping the learned rates, e.g. at the start of an execution.
+        '''
+        with cls.limiters_lock:
+            limiters = list(cls.limiters.values())
+        for limiter in limiters:
+            limiter.reset()
+
+    def acquire(self):
+        '''
+        Blocks until a request can be sent at the current rate.
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.counters['acquired'] += 1
+                    self.counters['waited_seconds'] += waited
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def on_success(self):
+        '''
+        Grows the rate after a successful response.
+        '''
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        '''
+        Cuts the rate after a throttling or server error response.
+        '''
+        with self.lock:
+            self.counters['throttled'] += 1
+            now = time.monotonic()
+            if now - self.decreased_at >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self.tokens = min(self.tokens, 0.0)
+                self.decreased_at = now
+                self.counters['decreases'] += 1
+
+    def reset(self):
+        '''
+        Resets the counters, keeping the learned rate.
+        '''
+        with self.lock:
+            self.counters = {'acquired' : 0, 'throttled' : 0, 'decreases' : 0, 'waited_seconds' : 0.0}
+
+    def report(self) -> dict:
+        '''
+        Returns the current rate and the counters of the limiter.
+        '''
+        with self.lock:
+            report = dict(self.counters)
+            report['rate'] = round(self.rate, 2)
+            report['waited_seconds'] = round(report['waited_seconds'], 3)
+        return report
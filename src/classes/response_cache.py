@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+
+class ResponseCache:
+    '''
+    Local disk cache of API responses, with time to live and size bounded LRU eviction.
+    The entries keep the ETag and Last-Modified headers, so an expired entry can be revalidated with a conditional request.
+
+    Parameters:
+        - directory (str, optional): Folder where the responses are stored, /tmp is a tmpfs in Cloud Functions.
+        - ttl (float, optional): Seconds an entry is used without revalidation (default is 0, always revalidate).
+        - max_bytes (int, optional): Maximum size of the stored bodies, the least recently used entries are evicted above it.
+    '''
+    def __init__(self, directory: str = "/tmp/brasil_api_cache", ttl: float = 0, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits' : 0, 'revalidated' : 0, 'misses' : 0, 'evictions' : 0}
+        os.makedirs(directory, exist_ok= True)
+        self.load_index()
+
+    def load_index(self):
+        '''
+        Loads the metadata of the entries already stored in the directory, ordered by the last use.
+        '''
+        ls_entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    ls_entries.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+        for entry in sorted(ls_entries, key= lambda item : item['used_at']):
+            self.entries[entry['key']] = entry
+            self.size += entry['size']
+
+    def file_path(self, key: str, extension: str) -> str:
+        '''
+        Returns the path of a file of an entry.
+        '''
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + extension)
+
+    def get(self, key: str) -> dict:
+        '''
+        Returns the metadata of an entry, marking it as recently used.
+
+        Returns:
+            dict: The entry metadata or None when the key is not cached.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            entry['used_at'] = time.time()
+            return dict(entry)
+
+    def is_fresh(self, entry: dict) -> bool:
+        '''
+        Checks if an entry can be used without revalidation.
+        '''
+        return time.time() - entry['stored_at'] < self.ttl
+
+    def conditional_headers(self, entry: dict) -> dict:
+        '''
+        Returns the headers to revalidate an entry with the server.
+        '''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def to_response(self, entry: dict, revalidated: bool = False) -> requests.Response:
+        '''
+        Builds a response object from a cached entry, with the attribute not_modified set.
+        '''
+        with open(self.file_path(entry['key'], '.body'), 'rb') as file:
+            body = file.read()
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.encoding = 'utf-8'
+        response._content = body
+        response.headers['Content-Type'] = entry['content_type']
+        response.not_modified = True
+        response.streamed = False
+        with self.lock:
+            if revalidated:
+                self.stats['revalidated'] += 1
+            else:
+                self.stats['hits'] += 1
+        return response
+
+    def put(self, key: str, response: requests.Response):
+        '''
+        Stores the body of a response, evicting the least recently used entries above the maximum size.
+        '''
+        body = response.content
+        if len(body) > self.max_bytes:
+            return
+        now = time.time()
+        entry = {
+            'key' : key,
+            'url' : response.url,
+            'etag' : response.headers.get('ETag'),
+            'last_modified' : response.headers.get('Last-Modified'),
+            'content_type' : response.headers.get('Content-Type', 'application/json'),
+            'size' : len(body),
+            'stored_at' : now,
+            'used_at' : now
+        }
+        with self.lock:
+            with open(self.file_path(key, '.body'), 'wb') as file:
+                file.write(body)
+            with open(self.file_path(key, '.json'), 'w') as file:
+                json.dump(entry, file)
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry['size']
+            self.entries[key] = entry
+            self.size += entry['size']
+            while self.size > self.max_bytes:
+                old_key, old_entry = self.entries.popitem(last= False)
+                self.size -= old_entry['size']
+                self.stats['evictions'] += 1
+                for extension in ('.body', '.json'):
+                    try:
+                        os.remove(self.file_path(old_key, extension))
+                    except OSError:
+                        pass
+
+    def touch(self, key: str):
+        '''
+        Renews the time to live of an entry after a successful revalidation.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['stored_at'] = time.time()
+            with open(self.file_path(key, '.json'), 'w') as file:
+                json.dump(entry, file)
+
+    def report(self) -> dict:
+        '''
+        Returns the counters of the cache.
+        '''
+        with self.lock:
+            report = dict(self.stats)
+            report['entries'] = len(self.entries)
+            report['bytes'] = self.size
+        return report
@@ -0,0 +1,95 @@
+from classes.client_registry import ClientRegistry
+
+class Schemas:
+    '''
+    Explicitly declared schemas of the tables loaded by the pipeline, with the envelope fields as columns.
+    Each schema is a list of (column name, BigQuery type) pairs, and the envelope fields are dictionary encoded in Arrow,
+    as they are constant in each file. The Arrow and BigQuery schemas are built once per process and cached.
+    The natural key identifies a row across executions, and the clustering fields are used by the partitioned table.
+    '''
+    tables = {
+        'brasil_api.municipios' : {
+            'fields' : [
+                ('nome', 'STRING'),
+                ('codigo_ibge', 'STRING'),
+                ('endpoint', 'STRING'),
+                ('path', 'STRING'),
+                ('providers', 'STRING')
+            ],
+            'envelope' : ['endpoint', 'path', 'providers'],
+            'key' : ['codigo_ibge', 'endpoint', 'path', 'providers'],
+            'clustering' : ['path', 'providers']
+        }
+    }
+    arrow_types = {
+        'STRING' : 'string',
+        'INTEGER' : 'int64',
+        'FLOAT' : 'float64',
+        'BOOLEAN' : 'bool_'
+    }
+    arrow_schemas = {}
+    bigquery_schemas = {}
+
+    @classmethod
+    def fields(cls, table_id: str) -> list:
+        '''
+        Returns the declared fields of a table, or None when the table has no declared schema.
+
+        Parameters:
+            - table_id (str): The table in the format dataset.table.
+        '''
+        if table_id not in cls.tables:
+            return None
+        return cls.tables[table_id]['fields']
+
+    @classmethod
+    def key(cls, table_id: str) -> list:
+        '''
+        Returns the columns of the natural key of a table, or None when the table has no declared schema.
+        '''
+        if table_id not in cls.tables:
+            return None
+        return cls.tables[table_id]['key']
+
+    @classmethod
+    def clustering(cls, table_id: str) -> list:
+        '''
+        Returns the clustering fields of a table, or None when the table has no declared schema.
+        '''
+        if table_id not in cls.tables:
+            return None
+        return cls.tables[table_id]['clustering']
+
+    @classmethod
+    def arrow_schema(cls, table_id: str):
+        '''
+        Returns the declared schema of a table as a pyarrow.Schema, or None when the table has no declared schema.
+        '''
+        if table_id not in cls.tables:
+            return None
+        schema = cls.arrow_schemas.get(table_id)
+        if schema is None:
+            pa = ClientRegistry.import_module('pyarrow')
+            ls_fields = []
+            for name, type_ in cls.fields(table_id):
+                arrow_type = getattr(pa, cls.arrow_types[type_])()
+                if name in cls.tables[table_id]['envelope']:
+                    arrow_type = pa.dictionary(pa.int32(), arrow_type)
+                ls_fields.append(pa.field(name, arrow_type))
+            schema = pa.schema(ls_fields)
+            cls.arrow_schemas[table_id] = schema
+        return schema
+
+    @classmethod
+    def bigquery_schema(cls, table_id: str) -> list:
+        '''
+        Returns the declared schema of a table as a list of bigquery.SchemaField, or None when the table has no declared schema.
+        '''
+        if table_id not in cls.tables:
+            return None
+        schema = cls.bigquery_schemas.get(table_id)
+        if schema is None:
+            bigquery = ClientRegistry.import_module('google.cloud.bigquery')
+            schema = [bigquery.SchemaField(name, type_, mode= 'NULLABLE') for name, type_ in cls.fields(table_id)]
+            cls.bigquery_schemas[table_id] = schema
+        return schema
@@ -1,31 +1,89 @@
+import time
+module_started = time.perf_counter()
 from classes.api_orquestrator import ApiOrquestrator
-import google.cloud.logging
+from classes.client_registry import ClientRegistry
+from classes.instrumentation import Instrumentation
+from classes.rate_limiter import AdaptiveRateLimiter
+from classes.response_cache import ResponseCache
 import os
 import logging
-from logger import trace_id
+from logger import trace_id, trace_id_value
+
+ClientRegistry.record_import('main', module_started)
+response_cache = ResponseCache()
+invocations = 0
+
+def setup_logging():
+    '''
+    Attaches the Cloud Logging handler once per process, warm invocations reuse it.
+    '''
+    if 'logging' not in ClientRegistry.clients:
+        ClientRegistry.logging_client().setup_logging()
 
 def main(request):
+    global invocations
+    invocations += 1
+    AdaptiveRateLimiter.reset_all()
+    Instrumentation.reset()
+    run_id = {'run_id' : f"{trace_id_value}-{invocations}"}
 
     folder_name = request.args.get('folder')
     local = request.args.get('local')
+    max_workers = int(request.args.get('max_workers', 8))
+    shard_index = int(request.args.get('shard_index', 0))
+    shard_count = int(request.args.get('shard_count', 1))
+    landing_format = request.args.get('landing_format', 'json')
+    sink = request.args.get('sink', 'load_job')
+    write_mode = request.args.get('write_mode', 'append')
 
     if local == '1':
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] =  '../apt-theme-402300-32506a51a70d.json'
 
-    client = google.cloud.logging.Client()
-    client.setup_logging()
+    setup_logging()
 
     bucket_name = 'brasil_api'
-    logging.info('Starting Object Api Orquestrator' , extra={"json_fields": trace_id})
+    logging.info('Starting Object Api Orquestrator' , extra={"json_fields": {**trace_id, **run_id}})
     orquestrador = ApiOrquestrator(
         endpoint= "ibge/municipios/v1/",
         query_parameters =  { "providers" : "dados-abertos-br,gov,wikipedia"},
         path_parameters = ['AL' , 'RR'],
         download_folder= folder_name,
-        bucket= bucket_name
+        bucket= bucket_name,
+        max_workers= max_workers,
+        response_cache= response_cache,
+        shard_index= shard_index,
+        shard_count= shard_count,
+        landing_format= landing_format,
+        sink= sink,
+        write_mode= write_mode
     )
-    logging.info('Executings requests to API', extra={"json_fields": trace_id})
-    orquestrador.execute_requests_envelope_save_file()
-    logging.info('Opening Json Files from Cloud Storage and Saving in Big Query' , extra={"json_fields": trace_id})
-    orquestrador.json_files_to_big_query(bucket_name, folder_name)
-    return ('Script executed with sucess')
\ No newline at end of file
+    backfill_folders = request.args.get('backfill_folders')
+    backfill_start = request.args.get('backfill_start')
+    if backfill_folders or backfill_start:
+        logging.info('Reloading landed folders from Cloud Storage into Big Query', extra={"json_fields": trace_id})
+        summary = orquestrador.execute_backfill(
+            bucket_name,
+            folders= backfill_folders.split(',') if backfill_folders else None,
+            start_date= backfill_start,
+            end_date= request.args.get('backfill_end'),
+            date_format= request.args.get('backfill_date_format', '%Y-%m-%d'),
+            max_parse_workers= int(request.args.get('parse_workers', 0))
+        )
+        failed = summary['failed'] + summary['load_failed']
+    elif request.args.get('pipeline', '1') == '1':
+        logging.info('Executing requests to API and saving in Cloud Storage and Big Query as a pipeline', extra={"json_fields": trace_id})
+        failed = orquestrador.execute_pipeline(manifest= folder_name is not None)['failed']
+    else:
+        logging.info('Executings requests to API', extra={"json_fields": trace_id})
+        failed = orquestrador.execute_requests_envelope_save_file()['failed']
+        logging.info('Opening Json Files from Cloud Storage and Saving in Big Query' , extra={"json_fields": trace_id})
+        orquestrador.json_files_to_big_query(bucket_name, folder_name, batch= True, manifest= folder_name is not None, from_uri= landing_format in ('parquet', 'ndjson.gz'))
+    logging.info('Startup report', extra={"json_fields": {**trace_id, **run_id, 'cold_start' : invocations == 1, **ClientRegistry.report()}})
+    logging.info('Response cache', extra={"json_fields": {**trace_id, **run_id, **response_cache.report()}})
+    logging.info('Cloud Storage bucket cache', extra={"json_fields": {**trace_id, **run_id, **orquestrador.storage_object.bucket_cache_report()}})
+    logging.info('Rate limiter', extra={"json_fields": {**trace_id, **run_id, 'hosts' : AdaptiveRateLimiter.report_all()}})
+    logging.info('Stage metrics', extra={"json_fields": {**trace_id, **run_id, 'stages' : Instrumentation.summary()}})
+    if failed > 0:
+        logging.warning(f'Script executed with {failed} failures', extra={"json_fields": {**trace_id, **run_id}})
+        return (f'Script executed with {failed} failures', 500)
+    return ('Script executed with sucess')